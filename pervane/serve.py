@@ -34,22 +34,42 @@ pip3 install -r requirements.txt
 # Run simple:
 python3 serve.py --dir=example/ --debug=true
 """
+import abc
 import argparse
-import base64
+import bisect
+import collections
+import concurrent.futures
+import contextlib
 import datetime
+import gzip
+import hashlib
+import heapq
+import html
 import json
 import logging
 import mimetypes
+import mmap
+import multiprocessing
 import os
 import pathlib
 import re
 import shutil
+import sqlite3
+import struct
 import subprocess
 import sys
+import threading
+import time
+import urllib.parse
 from operator import itemgetter
+try:
+  from re import _parser as sre_parse
+except ImportError:
+  # Before python 3.11.
+  import sre_parse
 
 from jinja2 import Environment, BaseLoader
-from flask import Flask, render_template, request, jsonify, redirect, url_for, send_from_directory, flash, session
+from flask import Flask, render_template, request, jsonify, redirect, url_for, send_file, flash, session, stream_with_context
 from flask_caching import Cache
 from flask_sqlalchemy import SQLAlchemy
 
@@ -57,6 +77,8 @@ from flask_login import LoginManager, UserMixin, login_user, logout_user, login_
 # from flask_user import current_user, login_required, UserManager, UserMixin
 
 
+from werkzeug.exceptions import NotFound
+from werkzeug.http import http_date, is_resource_modified
 from werkzeug.routing import BaseConverter
 from werkzeug.security import generate_password_hash, check_password_hash
 from werkzeug.utils import secure_filename
@@ -64,6 +86,29 @@ from atomicfile import AtomicFile
 
 import bcrypt
 
+try:
+  import fcntl
+except ImportError:
+  # Windows, generation bumps are not locked across processes there.
+  fcntl = None
+
+try:
+  from watchdog.events import FileSystemEventHandler
+  from watchdog.observers import Observer
+except ImportError:
+  # watchdog is optional. Without it the file tree index only relies on the
+  # periodic resync and pervane's own writes to stay current.
+  FileSystemEventHandler = object
+  Observer = None
+
+try:
+  from PIL import features as pil_features
+  from PIL import Image, ImageOps
+except ImportError:
+  # Pillow is optional. Without it the gallery shows the original images
+  # instead of the thumbnails.
+  Image = None
+
 mimetypes.init()
 
 def _str2bool(v):
@@ -97,14 +142,101 @@ parser.add_argument('--username', dest='username', default=None,
                     help='This is deprecated, please use cookie based login.')
 parser.add_argument('--password', dest='password', default=None,
                     help='This is deprecated, please use cookie based login.')
-parser.add_argument('--cache_seconds', dest='cache_seconds', default=2,
-                    help='Cache the sidebar file tree creation.')
+parser.add_argument('--cache_seconds', dest='cache_seconds', type=int,
+                    default=2,
+                    help='Cache the filesystem lookups like .pervaneignore '
+                         'files for this many seconds.')
+parser.add_argument(
+    '--cache_type', dest='cache_type', default='simple',
+    choices=['simple', 'filesystem', 'redis'],
+    help='Where to keep the file tree snapshots. simple is per process, '
+         'filesystem (under --config_dir) and redis are shared by all the '
+         'gunicorn workers.')
+parser.add_argument(
+    '--cache_redis_url', dest='cache_redis_url',
+    default=os.environ.get('PERVANE_CACHE_REDIS_URL',
+                           'redis://localhost:6379/0'),
+    help='Redis url for --cache_type=redis.')
+parser.add_argument(
+    '--tree_resync_seconds', dest='tree_resync_seconds', type=int, default=30,
+    help='Interval to check the directory mtimes and resync the in-memory file '
+         'tree index. Filesystem events (needs watchdog package) update the '
+         'index instantly, this is the fallback. 0 disables it.')
+parser.add_argument(
+    '--tree_depth', dest='tree_depth', type=int, default=0,
+    help='Depth of the file tree sent with the front page. Deeper dirs are '
+         'loaded when they are expanded in the sidebar, helps with huge '
+         'note dirs. 0 sends the full tree.')
+parser.add_argument(
+    '--index_cache_bytes', dest='index_cache_bytes', type=int,
+    default=256 * 1024 * 1024,
+    help='Approximate memory budget of the in-memory file tree indexes. In '
+         'multi user mode, least recently used users\' indexes are dropped '
+         'beyond it.')
+parser.add_argument(
+    '--scan_workers', dest='scan_workers', type=int, default=1,
+    help='Number of threads listing the dirs concurrently while building the '
+         'file tree. Helps when the notes are on a high latency filesystem '
+         'like NFS or SMB. 1 walks sequentially.')
+parser.add_argument(
+    '--search_backend', dest='search_backend', default='index',
+    choices=['index', 'grep', 'rg', 'ag', 'ack', 'python'],
+    help='index searches the full text index kept in an SQLite database under '
+         '--config_dir. The others scan the notes for every query: grep picks '
+         'the first installed one of rg, ag and ack, python needs nothing '
+         'installed. That one is also used while the index is being built for '
+         'the first time.')
+parser.add_argument(
+    '--grep_workers', dest='grep_workers', type=int, default=2,
+    help='Number of processes of the python search backend, each gunicorn '
+         'worker starts its own. 0 uses one per CPU.')
+parser.add_argument(
+    '--search_concurrency', dest='search_concurrency', type=int, default=4,
+    help='Number of the scanning searches (grep tools, regex) a process runs '
+         'at once, the others wait for them.')
+parser.add_argument(
+    '--search_as_you_type_ms', dest='search_as_you_type_ms', type=int,
+    default=200,
+    help='Time limit of the searches run while the query is typed, the '
+         'results found by then are shown.')
+parser.add_argument(
+    '--media_offload', dest='media_offload', default='none',
+    choices=['none', 'x_sendfile', 'x_accel_redirect'],
+    help='Lets the web server in front of pervane send the images and videos. '
+         'Pervane only checks the access and replies with an X-Sendfile '
+         '(Apache, lighttpd) or X-Accel-Redirect (nginx) header. none sends '
+         'them from pervane.')
+parser.add_argument(
+    '--media_offload_prefix', dest='media_offload_prefix',
+    default='/_pervane_media/',
+    help='Internal nginx location serving --dir for '
+         '--media_offload=x_accel_redirect.')
+parser.add_argument(
+    '--thumbnail_workers', dest='thumbnail_workers', type=int, default=2,
+    help='Number of threads making the thumbnails of the directory gallery '
+         'images. Needs the Pillow package.')
+parser.add_argument(
+    '--thumbnail_cache_bytes', dest='thumbnail_cache_bytes', type=int,
+    default=512 * 1024 * 1024,
+    help='Disk budget of the thumbnails kept under --config_dir. Least '
+         'recently used ones are deleted beyond it.')
+parser.add_argument(
+    '--content_cache_bytes', dest='content_cache_bytes', type=int,
+    default=64 * 1024 * 1024,
+    help='Memory budget of the note contents kept by each worker process for '
+         'the reads. Hits and misses are shown at /api/cache_stats.')
+parser.add_argument(
+    '--large_file_bytes', dest='large_file_bytes', type=int,
+    default=4 * 1024 * 1024,
+    help='Text files larger than this are shown in a paged read-only viewer '
+         'instead of the editor, read a window at a time.')
 parser.add_argument(
     '--ignore_patterns', dest='ignore_patterns', nargs='*',
     default=['env/.*', '.git', '.*.swp', '.*.pyc', '__pycache__', '.allmark',
              '_vnote.json', '!!!meta.json', 'PaxHeader', '.nojekyll',
              '.*.sqlite', '.*.plist'],
-    help='Ignored file patterns during file tree creation.')
+    help='Ignored file patterns (regex) during file tree creation and search. '
+         'Gitignore style .pervaneignore files in the dirs are honored too.')
 parser.add_argument(
     '--note_extensions', dest='note_extensions', nargs='*',
     default=['.txt', '.md', '.markdown'],
@@ -200,8 +332,25 @@ class ConfigClass(object):
   # USER_COPYRIGHT_YEAR = '2023'
   # USER_APP_VERSION = 'beta'
 
+def _get_cache_config():
+  if args.cache_type == 'filesystem':
+    return {
+        'CACHE_TYPE': 'FileSystemCache',
+        'CACHE_DIR': os.path.join(_PERVANE_CONFIG_DIR, 'cache'),
+        'CACHE_DEFAULT_TIMEOUT': 0,
+    }
+  if args.cache_type == 'redis':
+    return {
+        'CACHE_TYPE': 'RedisCache',
+        'CACHE_REDIS_URL': args.cache_redis_url,
+        'CACHE_KEY_PREFIX': 'pervane_',
+        'CACHE_DEFAULT_TIMEOUT': 0,
+    }
+  return {'CACHE_TYPE': 'SimpleCache', 'CACHE_DEFAULT_TIMEOUT': 0}
+
+
 logging.basicConfig(level=logging.DEBUG)
-cache = Cache(config={'CACHE_TYPE': 'simple'})
+cache = Cache(config=_get_cache_config())
 app = Flask(__name__, template_folder='templates')
 cache.init_app(app)
 
@@ -287,14 +436,6 @@ def _get_root_dir(trailing_separator = True):
   return path + os.path.sep if trailing_separator else path
 
 
-def _is_program_installed(binary):
-  rc = subprocess.call(['which', binary])
-  if rc == 0:
-    return True 
-  else:
-    return False
-
-
 def _is_filename_allowed(filename):
   return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
@@ -321,79 +462,1483 @@ def get_mime_type(path):
   return 'text/unknown'
 
 
-@cache.cached(timeout=args.cache_seconds, key_prefix='_make_tree')
-def make_tree(path):
-  """Higher level function to be used with cache."""
-  return _make_tree(path)
+def make_tree(path, depth=0):
+  """Higher level function to get the file tree from the in-memory index."""
+  return _get_tree_index(path).subtree(os.sep, depth)
 
 
-def _get_workspace_path(path):
+def _get_workspace_path(path, root_dir=None):
   """Shortens the given absolute path by removing the root dir.
   
   For instance, /home/user/pervane/note-dir/note1.md becomes
   /note-dir/note1.md"""
-  path = path.replace(_get_root_dir(trailing_separator=False), '')
+  if root_dir is None:
+    root_dir = _get_root_dir(trailing_separator=False)
+  path = path.replace(root_dir, '')
   return path if path.startswith(os.sep) else os.path.join(os.sep, path)
 
 
-def _make_tree(path):
+def _list_dir(path, workspace_path):
+  """Lists the direct children of the given dir as tree nodes.
+
+  Built on os.scandir, so the file type comes with the listing (d_type) and
+  files cost no stat. Only the child dirs are stat'ed, for the mtime the tree
+  index resyncs by. Workspace paths are made by appending the names to the
+  workspace path of the dir. Child dirs are returned without their children.
+  Nodes are sorted the same way with _make_tree.
+  """
+  nodes = []
+  prefix = workspace_path.rstrip(os.sep) + os.sep
+  try:
+    entries = os.scandir(path)
+  except OSError:
+    return nodes #ignore errors
+
+  with entries:
+    for entry in entries:
+      if is_ignored(entry.path):
+        continue
+
+      try:
+        mtime = entry.stat().st_mtime if entry.is_dir() else None
+      except OSError:
+        # Broken symlinks etc.
+        mtime = None
+
+      if mtime is not None:
+        nodes.append(dict(
+          name=entry.name, path=prefix + entry.name,
+          children=[], kind='dir', mtime=mtime))
+      else:
+        nodes.append(dict(
+          name=entry.name, path=prefix + entry.name,
+          kind='file', ext=os.path.splitext(entry.name)[1]))
+
+  # Sort by two keys.
+  # Kind is for sorting the directories first.
+  # Name is for natural alphabetical order within directories and files 
+  # separately.
+  return sorted(nodes, key=itemgetter('kind', 'name'))
+
+
+def _make_tree(path, root_dir=None, scan_workers=None):
   """Recursive function to get the file/dir tree.
 
-  Can not be cached due to recursion.
+  root_dir is needed when there is no request context, eg. in the tree index
+  threads.
   """
   if is_ignored(path):
    return
 
   this_node = dict(name=os.path.basename(path),
-              path=_get_workspace_path(path),
-              children=[], kind='dir')
+              path=_get_workspace_path(path, root_dir),
+              children=[], kind='dir', mtime=_get_mtime(path) or 0)
+  return _fill_tree(path, this_node, scan_workers)
+
+
+def _fill_tree(path, node, scan_workers=None):
+  """Walks the dir at the given path into the given dir node.
+
+  scan_workers defaults to the --scan_workers flag.
+  """
+  if scan_workers is None:
+    scan_workers = args.scan_workers
+  if scan_workers > 1:
+    return _fill_tree_parallel(path, node, scan_workers)
+
+  node['children'] = [
+      _fill_tree(os.path.join(path, child['name']), child, 1)
+      if child['kind'] == 'dir' else child
+      for child in _list_dir(path, node['path'])]
+  return node
+
+
+def _fill_tree_parallel(path, node, scan_workers):
+  """Same as _fill_tree but the dirs are listed on a bounded thread pool.
 
+  Every listed dir submits the listings of its child dirs, so the round trips
+  of a high latency filesystem overlap instead of blocking each other. Each
+  listing is sorted already, so the result is the same with _fill_tree.
+  """
+  with concurrent.futures.ThreadPoolExecutor(
+      max_workers=scan_workers) as executor:
+    pending = {executor.submit(_list_dir, path, node['path']): (path, node)}
+    while pending:
+      done, _ = concurrent.futures.wait(
+          pending, return_when=concurrent.futures.FIRST_COMPLETED)
+      for future in done:
+        dir_path, dir_node = pending.pop(future)
+        dir_node['children'] = future.result()
+        for child in dir_node['children']:
+          if child['kind'] == 'dir':
+            child_path = os.path.join(dir_path, child['name'])
+            pending[executor.submit(_list_dir, child_path, child['path'])] = (
+                child_path, child)
+  return node
+
+
+def _get_mtime(path):
   try:
-    children = os.listdir(path)
+    return os.stat(path).st_mtime
   except OSError:
-    pass #ignore errors
+    return None
+
+
+# Approximate memory of a tree node dict apart from its strings.
+_TREE_NODE_OVERHEAD_BYTES = 400
+# Number of file path list changes kept for incremental /api/file_paths.
+_FILE_PATHS_CHANGES_SIZE = 50
+
+
+# Results of /api/find_file by default and at most.
+_FIND_FILE_LIMIT = 50
+_FIND_FILE_LIMIT_MAX = 500
+# Matches scoring lower are dropped, the threshold the quick search used.
+_FIND_FILE_THRESHOLD = -100000
+
+
+def _next_beginnings(target):
+  """Index of the next word beginning after each index of the target.
+
+  Beginnings are the uppercase letters after lowercase ones and the
+  characters next to a non alphanumeric one, as in fuzzysort.
+  """
+  beginnings = []
+  was_upper = was_alnum = False
+  for c in target:
+    is_upper = 'A' <= c <= 'Z'
+    is_alnum = is_upper or 'a' <= c <= 'z' or '0' <= c <= '9'
+    beginnings.append(is_upper and not was_upper or not was_alnum or
+                      not is_alnum)
+    was_upper, was_alnum = is_upper, is_alnum
+  next_beginnings = [len(target)] * len(target)
+  next_beginning = len(target)
+  for i in range(len(target) - 1, -1, -1):
+    next_beginnings[i] = next_beginning
+    if beginnings[i]:
+      next_beginning = i
+  return next_beginnings
+
+
+def _fuzzy_match(query, text, start=0):
+  """Returns how many query chars are found in order in the text from start.
+
+  start is the number of the query chars matched already, eg. in the parent
+  dirs of a path.
+  """
+  pos = 0
+  for i in range(start, len(query)):
+    pos = text.find(query[i], pos)
+    if pos < 0:
+      return i
+    pos += 1
+  return len(query)
+
+
+def _fuzzy_score(query, path, lower_path, next_beginnings):
+  """Scores the lowercase query against the path like fuzzysort, no typos.
+
+  Returns the score and the matched indexes, None if the path doesn't have
+  all the query chars in order. Matches at the word beginnings and in
+  consecutive runs score higher, 0 is an exact match.
+  """
+  simple = []
+  pos = 0
+  for c in query:
+    pos = lower_path.find(c, pos)
+    if pos < 0:
+      return None
+    simple.append(pos)
+    pos += 1
+
+  # Tries again only with the consecutive chars and the word beginnings.
+  path_len = len(path)
+  strict = []
+  i = 0 if simple[0] == 0 else next_beginnings[simple[0] - 1]
+  strict_matched = False
+  while i < path_len or strict:
+    if i >= path_len:
+      # Pushes the previous query char to its next possible place.
+      i = next_beginnings[strict.pop()]
+    elif query[len(strict)] == lower_path[i]:
+      strict.append(i)
+      if len(strict) == len(query):
+        strict_matched = True
+        break
+      i += 1
+    else:
+      i = next_beginnings[i]
+
+  matches = strict if strict_matched else simple
+  score = 0
+  last = -1
+  for i in matches:
+    if i != last + 1:
+      score -= i
+    last = i
+  if not strict_matched:
+    score *= 1000
+  return score - (path_len - len(query)), matches
+
+
+class _FileNameIndex(object):
+  """Fuzzy file name search of the quick open, as a trie of path segments.
+
+  Dir nodes hold the lowercase names of their child dirs and files, so a
+  query is matched against each dir once and only continued into the names
+  below it. Each node also has the chars of the names under it, to skip the
+  subtrees missing the rest of the query. Only the paths matching all the
+  query chars and able to make it to the top get scored. Kept current by the
+  tree index.
+  """
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._root = self._new_node()
+    self.size = 0
+
+  @staticmethod
+  def _new_node():
+    # dirs: name => node, files: name => (lower name, path, lower path,
+    # next beginnings of the path). chars only grow, a removal leaves some
+    # extra ones which just prune less.
+    return {'dirs': {}, 'files': {}, 'chars': set()}
+
+  def _get_node(self, parts, create=False, chars=None):
+    """Returns the node of the dir parts, adding the chars on the way."""
+    node = self._root
+    for i, part in enumerate(parts):
+      if chars:
+        node['chars'].update(chars, *[part.lower() + os.sep
+                                      for part in parts[i:]])
+      child = node['dirs'].get(part)
+      if child is None:
+        if not create:
+          return None
+        child = node['dirs'][part] = self._new_node()
+        child['lower'] = part.lower() + os.sep
+      node = child
+    if chars:
+      node['chars'].update(chars)
+    return node
+
+  def add(self, path):
+    """Adds the workspace path of a file."""
+    parts = path.strip(os.sep).split(os.sep)
+    lower_path = path.lower()
+    if len(lower_path) != len(path):
+      # Keeps the indexes of the matches, eg. for the dotted capital I.
+      lower_path = ''.join(c.lower()[:1] for c in path)
+    lower_name = parts[-1].lower()
+    with self._lock:
+      files = self._get_node(parts[:-1], create=True, chars=lower_name)['files']
+      if parts[-1] not in files:
+        self.size += 1
+      files[parts[-1]] = (lower_name, path, lower_path,
+                          _next_beginnings(path))
+
+  def remove_file(self, path):
+    parts = path.strip(os.sep).split(os.sep)
+    with self._lock:
+      parent = self._get_node(parts[:-1])
+      if parent and parent['files'].pop(parts[-1], None) is not None:
+        self.size -= 1
+
+  def remove_dir(self, path):
+    """Removes the workspace path of a dir with all the files under it."""
+    parts = path.strip(os.sep).split(os.sep)
+    with self._lock:
+      parent = self._get_node(parts[:-1])
+      node = parent and parent['dirs'].pop(parts[-1], None)
+      nodes = [node] if node else []
+      while nodes:
+        node = nodes.pop()
+        self.size -= len(node['files'])
+        nodes.extend(node['dirs'].values())
+
+  def find(self, query, limit=_FIND_FILE_LIMIT):
+    """Returns the top (score, path, matched indexes) of the query."""
+    query = query.lower()
+    query_len = len(query)
+    results = []
+    # Lowest score of the top results so far. Nothing scores better than
+    # the length difference of the path and the query, minus the index of
+    # the first query char.
+    top_scores = []
+    min_score = _FIND_FILE_THRESHOLD
+    with self._lock:
+      # Workspace paths start with the separator.
+      nodes = [(self._root, _fuzzy_match(query, os.sep))]
+      while nodes:
+        node, matched = nodes.pop()
+        if not node['chars'].issuperset(query[matched:]):
+          continue
+        for child in node['dirs'].values():
+          nodes.append((child, _fuzzy_match(query, child['lower'], matched)))
+        for lower_name, path, lower_path, next_beginnings in (
+            node['files'].values()):
+          if query_len - len(path) < min_score or (
+              matched < query_len and
+              _fuzzy_match(query, lower_name, matched) < query_len):
+            continue
+          if query_len - len(path) - lower_path.find(query[0]) < min_score:
+            continue
+          score, indexes = _fuzzy_score(
+              query, path, lower_path, next_beginnings)
+          if score < min_score:
+            continue
+          results.append((score, path, indexes))
+          heapq.heappush(top_scores, score)
+          if len(top_scores) > limit:
+            heapq.heappop(top_scores)
+          if len(top_scores) == limit:
+            min_score = top_scores[0]
+    return heapq.nsmallest(limit, results, key=lambda r: (-r[0], r[1]))
+
+
+class _TreeIndex(object):
+  """In-memory file tree of a root dir which is kept current in place.
+
+  The tree is built once and then updated one directory at a time by the
+  filesystem events, the periodic mtime resync and pervane's own writers.
+  Children lists are replaced instead of mutated, so a reader never sees a
+  half updated directory.
+  """
+
+  def __init__(self, root_dir, tree=None):
+    """Walks the root dir unless a tree snapshot is given."""
+    self.root_dir = root_dir
+    self.generation = 0
+    # Generation of the cross-worker counter this tree is in sync with.
+    self.shared_generation = None
+    self._lock = threading.RLock()
+    # Workspace path of the dir => dir node and its last seen mtime.
+    self._dirs = {}
+    self._dir_mtimes = {}
+    self._response_json = None
+    self._response_etag = None
+    self._response_generation = None
+    self._file_paths = None
+    self._file_paths_generation = None
+    self._file_paths_version = None
+    self._versioned_file_paths = []
+    # (from version, to version, added paths, removed paths) per change.
+    self._file_paths_changes = collections.deque(
+        maxlen=_FILE_PATHS_CHANGES_SIZE)
+    self.file_names = _FileNameIndex()
+    # Filesystem watch of this index, if watchdog is installed.
+    self.watch = None
+    if tree is None:
+      # Trailing separator makes the root node nameless, like the old tree.
+      tree = _make_tree(root_dir + os.sep, root_dir)
+    self.tree = tree
+    self._register(self.tree)
+
+  def load(self, tree):
+    """Replaces the whole tree, eg. with a snapshot of another worker."""
+    with self._lock:
+      self._dirs = {}
+      self._dir_mtimes = {}
+      self.file_names = _FileNameIndex()
+      self.tree = tree
+      self._register(tree)
+      self.generation += 1
+
+  def _to_real_path(self, workspace_path):
+    # No realpath here, symlinked dirs are listed under their link name.
+    return os.path.normpath(
+        os.path.join(self.root_dir, workspace_path.lstrip(os.sep)))
+
+  def _register(self, node):
+    self._dirs[node['path']] = node
+    self._dir_mtimes[node['path']] = node['mtime']
+    for child in node['children']:
+      if child['kind'] == 'dir':
+        self._register(child)
+      else:
+        self.file_names.add(child['path'])
+
+  def _unregister(self, node):
+    self._dirs.pop(node['path'], None)
+    self._dir_mtimes.pop(node['path'], None)
+    for child in node['children']:
+      if child['kind'] == 'dir':
+        self._unregister(child)
+    self.file_names.remove_dir(node['path'])
+
+  def refresh_dir(self, path):
+    """Re-lists the given absolute dir path and merges it into the tree.
+
+    Known child dirs keep their subtrees, new ones are walked from scratch.
+    """
+    if not (path + os.sep).startswith(self.root_dir + os.sep):
+      return
+    if path != self.root_dir and is_ignored(path):
+      return
+
+    workspace_path = _get_workspace_path(path, self.root_dir)
+    with self._lock:
+      node = self._dirs.get(workspace_path)
+      if node is None:
+        # Not known yet, eg. nested dirs are created at once. Refreshing the
+        # closest known parent walks it.
+        if path != self.root_dir:
+          self.refresh_dir(os.path.dirname(path))
+        return
+
+      old_children = {(child['kind'], child['name']): child
+                      for child in node['children']}
+      children = []
+      for child in _list_dir(path, workspace_path):
+        old_child = old_children.pop((child['kind'], child['name']), None)
+        if child['kind'] == 'dir':
+          if old_child is None:
+            old_child = _fill_tree(os.path.join(path, child['name']), child)
+            self._register(old_child)
+          else:
+            # Only the mtime shown, resync tracks its own copy.
+            old_child['mtime'] = child['mtime']
+          children.append(old_child)
+        else:
+          if old_child is None:
+            self.file_names.add(child['path'])
+          children.append(child)
+
+      for old_child in old_children.values():
+        if old_child['kind'] == 'dir':
+          self._unregister(old_child)
+        else:
+          self.file_names.remove_file(old_child['path'])
+
+      self._dir_mtimes[workspace_path] = _get_mtime(path)
+      if ([(c['kind'], c['name']) for c in children] !=
+          [(c['kind'], c['name']) for c in node['children']]):
+        node['children'] = children
+        self.generation += 1
+
+  def resync(self):
+    """Refreshes the dirs whose mtime changed since the last listing."""
+    with self._lock:
+      dir_mtimes = list(self._dir_mtimes.items())
+    for workspace_path, mtime in dir_mtimes:
+      path = self._to_real_path(workspace_path)
+      if _get_mtime(path) != mtime:
+        # Deleted dirs are dropped by their parent's listing.
+        self.refresh_dir(path if os.path.isdir(path) else os.path.dirname(path))
+
+  def subtree(self, workspace_path, depth=0):
+    """Returns the dir node of the given workspace path, None if unknown.
+
+    With a positive depth, the node is copied down to that depth and dirs
+    beyond it come without children. child_count lets the UI show the expander
+    of such dirs without loading them.
+    """
+    with self._lock:
+      node = self._dirs.get(workspace_path)
+      if node is None or depth <= 0:
+        return node
+      return _slice_tree(node, depth)
+
+  def size_bytes(self):
+    """Rough memory use, the JSON size plus the dict overhead per node."""
+    with self._lock:
+      return len(self.response_json()) + _TREE_NODE_OVERHEAD_BYTES * (
+          len(self._dirs) + len(self.file_paths()))
+
+  def file_paths(self):
+    """Workspace paths of all the files, rebuilt only when the tree changes."""
+    with self._lock:
+      if self._file_paths_generation != self.generation:
+        file_paths = []
+        nodes = [self.tree]
+        while nodes:
+          for child in nodes.pop()['children']:
+            if child['kind'] == 'dir':
+              nodes.append(child)
+            else:
+              file_paths.append(child['path'])
+        self._file_paths = file_paths
+        self._file_paths_generation = self.generation
+      return self._file_paths
+
+  def file_paths_version(self):
+    """Returns the version of the file paths and the paths.
+
+    The version is a hash of the paths, so it is the same in all the workers
+    for the same files. Changes between the versions are journaled for
+    file_paths_changes.
+    """
+    with self._lock:
+      file_paths = self.file_paths()
+      if file_paths is not self._versioned_file_paths:
+        version = hashlib.sha1(
+            '\n'.join(file_paths).encode('utf-8')).hexdigest()[:16]
+        if self._file_paths_version not in (None, version):
+          old_paths = set(self._versioned_file_paths)
+          new_paths = set(file_paths)
+          self._file_paths_changes.append((
+              self._file_paths_version, version,
+              sorted(new_paths - old_paths), sorted(old_paths - new_paths)))
+        self._file_paths_version = version
+        self._versioned_file_paths = file_paths
+      return self._file_paths_version, file_paths
+
+  def file_paths_changes(self, since_version):
+    """Returns (added, removed) paths since the given version.
+
+    None is returned if the version is too old or unknown to this worker.
+    """
+    version, _ = self.file_paths_version()
+    added = set()
+    removed = set()
+    with self._lock:
+      if since_version == version:
+        return [], []
+      from_versions = [change[0] for change in self._file_paths_changes]
+      if since_version not in from_versions:
+        return None
+      start = len(from_versions) - 1 - from_versions[::-1].index(since_version)
+      for _, _, change_added, change_removed in list(
+          self._file_paths_changes)[start:]:
+        added.update(change_added)
+        removed.difference_update(change_added)
+        removed.update(change_removed)
+        added.difference_update(change_removed)
+    return sorted(added), sorted(removed)
+
+  def response_json(self):
+    """Serialized /api/get_tree response, rebuilt only when the tree changes."""
+    with self._lock:
+      if self._response_generation != self.generation:
+        self._response_json = json.dumps(
+            {'result': 'success', 'content': self.tree})
+        # Hash of the content, so it is the same in all the workers.
+        self._response_etag = hashlib.sha1(
+            self._response_json.encode('utf-8')).hexdigest()[:16]
+        self._response_generation = self.generation
+      return self._response_json
+
+  def response_etag(self):
+    with self._lock:
+      self.response_json()
+      return self._response_etag
+
+
+def _slice_tree(node, depth):
+  sliced = dict(node, child_count=len(node['children']))
+  if depth <= 0:
+    sliced['children'] = []
   else:
-    for child_name in children:
-      child_path = os.path.join(path, child_name)
+    sliced['children'] = [
+        _slice_tree(child, depth - 1) if child['kind'] == 'dir' else child
+        for child in node['children']]
+  return sliced
+
+
+# Events changing the files. opened and closed_no_write come with every read,
+# pervane's own too.
+_TREE_EVENT_TYPES = ('created', 'deleted', 'moved', 'modified', 'closed')
+
+
+class _TreeEventHandler(FileSystemEventHandler):
+  """Forwards the filesystem events to the tree and the search indexes."""
+
+  def __init__(self, tree_index):
+    self.tree_index = tree_index
+
+  def on_any_event(self, event):
+    if event.event_type not in _TREE_EVENT_TYPES:
+      return
+    if not (event.is_directory and event.event_type in ('modified', 'closed')):
+      _update_search_index(
+          event.src_path, getattr(event, 'dest_path', ''),
+          root_dir=self.tree_index.root_dir)
+    if event.event_type in ('modified', 'closed'):
+      if event.is_directory:
+        self.tree_index.refresh_dir(event.src_path)
+      # Content changes of the files don't change the tree.
+      return
+    self.tree_index.refresh_dir(os.path.dirname(event.src_path))
+    dest_path = getattr(event, 'dest_path', '')
+    if dest_path:
+      self.tree_index.refresh_dir(os.path.dirname(dest_path))
+
+
+class _SharedGeneration(object):
+  """Counter shared by the worker processes through a mmap'ed file.
+
+  It is bumped whenever pervane changes a file tree. Workers compare it with
+  the generation their tree index is in sync with, so a write in one worker
+  is seen by all the others on their next request.
+  """
+
+  def __init__(self, path):
+    self._path = path
+    with open(path, 'ab') as f:
+      if f.tell() < 8:
+        f.write(b'\0' * (8 - f.tell()))
+    with open(path, 'r+b') as f:
+      self._mmap = mmap.mmap(f.fileno(), 8)
+
+  def get(self):
+    return struct.unpack_from('Q', self._mmap)[0]
+
+  def bump(self):
+    # A new file description per bump, forked workers share the old ones and
+    # flock doesn't exclude them from each other.
+    with open(self._path, 'r+b') as f:
+      if fcntl:
+        fcntl.flock(f, fcntl.LOCK_EX)
+      generation = self.get() + 1
+      struct.pack_into('Q', self._mmap, 0, generation)
+      return generation
+
+
+class _CacheGeneration(object):
+  """Same with _SharedGeneration but kept in the cache backend, eg. redis."""
+
+  def __init__(self, cache, key):
+    self._cache = cache
+    self._key = key
+
+  def get(self):
+    return int(self._cache.get(self._key) or 0)
+
+  def bump(self):
+    # Atomic INCR with redis.
+    return self._cache.cache.inc(self._key)
+
+
+if args.cache_type == 'redis':
+  _tree_generation = _CacheGeneration(cache, 'tree_generation')
+else:
+  _tree_generation = _SharedGeneration(
+      os.path.join(_PERVANE_CONFIG_DIR, 'tree_generation'))
+
+
+def _get_cache_key(name, root_dir):
+  """Cache keys are per root dir, so users never see each other's data."""
+  return '%s:%s' % (name, root_dir)
+
+
+def _publish_tree_snapshot(tree_index, generation):
+  """Shares the tree with the other workers as of the given generation."""
+  with tree_index._lock:
+    snapshot = json.dumps(tree_index.tree)
+    tree_index.shared_generation = generation
+  cache.set(_get_cache_key('tree_snapshot', tree_index.root_dir), (generation, snapshot))
+
+
+def _sync_tree_index(tree_index):
+  """Catches up with the tree changes made by the other workers.
+
+  The snapshot of the latest generation is loaded if there is one, otherwise
+  the index resyncs by itself.
+  """
+  generation = _tree_generation.get()
+  if generation == tree_index.shared_generation:
+    return
+  snapshot = cache.get(_get_cache_key('tree_snapshot', tree_index.root_dir))
+  if snapshot and snapshot[0] == generation:
+    tree_index.load(json.loads(snapshot[1]))
+  else:
+    tree_index.resync()
+  tree_index.shared_generation = generation
+
+
+# Absolute root dir => _TreeIndex, least recently used first. There are
+# multiple roots only in multi user mode.
+_tree_indexes = collections.OrderedDict()
+_tree_indexes_lock = threading.Lock()
+_tree_observer = None
+_tree_resync_thread = None
+
+
+def _get_tree_index(root_dir):
+  """Returns the tree index of the root dir, builds it on the first call."""
+  global _tree_observer, _tree_resync_thread
+  root_dir = os.path.abspath(root_dir)
+  with _tree_indexes_lock:
+    tree_index = _tree_indexes.get(root_dir)
+    if tree_index is not None:
+      _tree_indexes.move_to_end(root_dir)
+  if tree_index is not None:
+    _sync_tree_index(tree_index)
+    return tree_index
+
+  with _tree_indexes_lock:
+    tree_index = _tree_indexes.get(root_dir)
+    if tree_index is not None:
+      # Built by another thread meanwhile.
+      return tree_index
+
+    # Another worker may have walked this tree already.
+    generation = _tree_generation.get()
+    snapshot = cache.get(_get_cache_key('tree_snapshot', root_dir))
+    if snapshot and snapshot[0] == generation:
+      logging.info('Loading the file tree index of %s', root_dir)
+      tree_index = _TreeIndex(root_dir, json.loads(snapshot[1]))
+      tree_index.shared_generation = generation
+    else:
+      logging.info('Building the file tree index of %s', root_dir)
+      tree_index = _TreeIndex(root_dir)
+      _publish_tree_snapshot(tree_index, generation)
+    _tree_indexes[root_dir] = tree_index
+
+    # Background workers are started lazily so that they are created in the
+    # actual serving process, eg. after gunicorn forks.
+    if _tree_resync_thread is None and args.tree_resync_seconds > 0:
+      _tree_resync_thread = threading.Thread(
+          target=_tree_resync_loop, daemon=True)
+      _tree_resync_thread.start()
+    if Observer is not None:
+      try:
+        if _tree_observer is None:
+          _tree_observer = Observer()
+          _tree_observer.daemon = True
+          _tree_observer.start()
+        tree_index.watch = _tree_observer.schedule(
+            _TreeEventHandler(tree_index), root_dir, recursive=True)
+      except Exception:
+        logging.error('Can not watch %s, relying on resync', root_dir,
+                      exc_info=True)
+    _evict_tree_indexes()
+    return tree_index
+
+
+def _evict_tree_indexes():
+  """Drops the least recently used indexes beyond --index_cache_bytes.
+
+  The most recently used one is always kept. Should be called with
+  _tree_indexes_lock.
+  """
+  total_bytes = sum(
+      tree_index.size_bytes() for tree_index in _tree_indexes.values())
+  while total_bytes > args.index_cache_bytes and len(_tree_indexes) > 1:
+    root_dir, tree_index = _tree_indexes.popitem(last=False)
+    total_bytes -= tree_index.size_bytes()
+    logging.info('Evicting the file tree index of %s', root_dir)
+    if tree_index.watch is not None:
+      _tree_observer.unschedule(tree_index.watch)
+    if args.cache_type == 'simple':
+      # The snapshot lives in this process' memory too.
+      cache.delete(_get_cache_key('tree_snapshot', root_dir))
+
+
+def _claim_periodic_task(path, seconds):
+  """Whether this worker process should run a task due every given seconds.
+
+  The time of the last run is kept in the file at path, so only one of the
+  workers runs it per interval.
+  """
+  if not fcntl:
+    return True
+  with open(path, 'a+b') as f:
+    try:
+      fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+      # Another worker is claiming it right now.
+      return False
+    f.seek(0)
+    try:
+      last_run = float(f.read() or 0)
+    except ValueError:
+      last_run = 0
+    now = time.time()
+    if now - last_run < seconds:
+      return False
+    f.seek(0)
+    f.truncate()
+    f.write(b'%f' % now)
+    return True
+
+
+def _tree_resync_loop():
+  while True:
+    time.sleep(args.tree_resync_seconds)
+    with _tree_indexes_lock:
+      tree_indexes = list(_tree_indexes.values())
+    for tree_index in tree_indexes:
+      try:
+        tree_index.resync()
+      except Exception:
+        logging.error('Tree index resync failed for %s', tree_index.root_dir,
+                      exc_info=True)
+    # Resyncs may grow the indexes.
+    with _tree_indexes_lock:
+      _evict_tree_indexes()
+    # Catches the content changes missed without the filesystem events. A
+    # sync stats all the notes, so it is done by one worker per interval.
+    with _search_indexes_lock:
+      search_indexes = list(_search_indexes.values())
+    for search_index in search_indexes:
+      try:
+        if _claim_periodic_task(search_index.db_path + '.sync',
+                                args.tree_resync_seconds):
+          _sync_search_index(search_index)
+      except Exception:
+        logging.error('Search index sync failed for %s',
+                      search_index.root_dir, exc_info=True)
+
+
+def _update_tree_index(*paths):
+  """Lets the tree index know about the paths created or removed by pervane.
+
+  Indexes which are not built yet are skipped, they'll see the change when
+  they are built. The other workers are notified through the shared
+  generation.
+  """
+  with _tree_indexes_lock:
+    tree_index = _tree_indexes.get(_get_root_dir(trailing_separator=False))
+  if tree_index is None:
+    _tree_generation.bump()
+    return
+  _sync_tree_index(tree_index)
+  for path in paths:
+    tree_index.refresh_dir(os.path.dirname(path))
+  _publish_tree_snapshot(tree_index, _tree_generation.bump())
+
+
+# Gitignore style ignore files which can live in any dir under the working dir.
+_IGNORE_FILE_NAME = '.pervaneignore'
+# Upper bound of the memoized ignore pattern results.
+_IGNORE_MEMO_SIZE = 200000
+
+
+def _glob_to_regex(pattern):
+  """Translates a gitignore style glob into a regex for / separated paths."""
+  regex = ''
+  i = 0
+  while i < len(pattern):
+    if pattern.startswith('**', i):
+      regex += '.*'
+      i += 2
+      continue
+    c = pattern[i]
+    if c == '*':
+      regex += '[^/]*'
+    elif c == '?':
+      regex += '[^/]'
+    elif c == '[' and pattern.find(']', i + 1) != -1:
+      end = pattern.find(']', i + 1)
+      chars = pattern[i + 1:end].replace('\\', '\\\\')
+      if chars.startswith('!'):
+        chars = '^' + chars[1:]
+      regex += '[' + chars + ']'
+      i = end
+    else:
+      regex += re.escape(c)
+    i += 1
+  return regex
 
-      if is_ignored(child_path):
-        continue
 
-      if os.path.isdir(child_path):
-        this_node['children'].append(_make_tree(child_path))
+def _compile_ignore_file(path):
+  """Compiles the patterns of an ignore file into one regex.
+
+  Patterns work like in .gitignore except negation. A pattern with a / is
+  relative to the ignore file's dir, others match a name at any level below.
+  None is returned if there are no patterns.
+  """
+  regexes = []
+  with open(path, 'r') as f:
+    for line in f:
+      line = line.strip()
+      if not line or line.startswith('#'):
+        continue
+      line = line.rstrip('/')
+      if '/' in line:
+        regexes.append('^' + _glob_to_regex(line.lstrip('/')) + '(?:/|$)')
       else:
-        this_node['children'].append(dict(
-          name=child_name, path=_get_workspace_path(child_path),
-          kind='file', ext=os.path.splitext(child_path)[1]))
-  
-  if len(this_node['children']) > 0:
-    # Sort by two keys.
-    # Kind is for sorting the directories first.
-    # Name is for natural alphabetical order within directories and files 
-    # separately.
-    this_node['children'] = sorted(
-        this_node['children'], key=itemgetter('kind', 'name'))
-  return this_node 
+        regexes.append('(?:^|/)' + _glob_to_regex(line) + '(?:/|$)')
+  return re.compile('|'.join(regexes)) if regexes else None
+
+
+class _IgnoreMatcher(object):
+  """Decides whether a path is ignored.
+
+  Ignore patterns are merged into a single compiled regex and searched in the
+  whole path as before. Results are memoized per path. In addition the
+  .pervaneignore files of the dirs between the base dir and the path are
+  applied. They are compiled once per dir and re-checked at most every
+  check_seconds, so editing them doesn't need a restart.
+
+  Everything under an ignored dir is ignored too, so walkers don't descend
+  into ignored dirs.
+  """
+
+  def __init__(self, patterns, base_dir, check_seconds):
+    self._regex = re.compile(
+        '|'.join('(?:%s)' % pattern for pattern in patterns)
+    ) if patterns else None
+    self._base_dir = base_dir
+    self._check_seconds = check_seconds
+    self._memo = {}
+    # Dir path => (checked at, ignore file mtime, compiled regex or None).
+    self._ignore_files = {}
+
+  def is_ignored(self, path):
+    path = str(path)
+    return self._matches_patterns(path) or self._matches_ignore_files(path)
+
+  def _matches_patterns(self, path):
+    result = self._memo.get(path)
+    if result is None:
+      if len(self._memo) >= _IGNORE_MEMO_SIZE:
+        self._memo.clear()
+      result = bool(self._regex and self._regex.search(path))
+      self._memo[path] = result
+    return result
+
+  def _matches_ignore_files(self, path):
+    if not path.startswith(self._base_dir + os.sep):
+      return False
+    names = path[len(self._base_dir) + 1:].rstrip(os.sep).split(os.sep)
+    dir_path = self._base_dir
+    for i, name in enumerate(names):
+      regex = self._get_ignore_file_regex(dir_path)
+      if regex and regex.search('/'.join(names[i:])):
+        return True
+      dir_path = os.path.join(dir_path, name)
+    return False
+
+  def _get_ignore_file_regex(self, dir_path):
+    now = time.time()
+    entry = self._ignore_files.get(dir_path)
+    if entry is not None and now - entry[0] < self._check_seconds:
+      return entry[2]
+
+    ignore_file = os.path.join(dir_path, _IGNORE_FILE_NAME)
+    mtime = _get_mtime(ignore_file)
+    regex = None
+    if entry is not None and entry[1] == mtime:
+      regex = entry[2]
+    elif mtime is not None:
+      try:
+        regex = _compile_ignore_file(ignore_file)
+      except (OSError, re.error):
+        logging.error('Can not read the ignore file %s', ignore_file,
+                      exc_info=True)
+    self._ignore_files[dir_path] = (now, mtime, regex)
+    return regex
+
+
+_ignore_matcher = _IgnoreMatcher(
+    args.ignore_patterns, _WORKING_DIR, args.cache_seconds)
 
 
 def is_ignored(file_path):
-  for pattern in args.ignore_patterns:
-    result = re.search(pattern, str(file_path))
-    if result:
+  return _ignore_matcher.is_ignored(file_path)
+
+
+def _is_fts5_available(tokenize='unicode61'):
+  try:
+    sqlite3.connect(':memory:').execute(
+        'CREATE VIRTUAL TABLE fts5_check USING fts5(content, tokenize=%s)' %
+        tokenize)
+    return True
+  except sqlite3.Error:
+    return False
+
+
+# Bumped when the tables change, older databases are rebuilt.
+_SEARCH_INDEX_SCHEMA = 4
+# Lets SQLite memory map this much of the index instead of reading it.
+_SEARCH_INDEX_MMAP_BYTES = 256 * 1024 * 1024
+# Larger files are not indexed.
+_SEARCH_INDEX_MAX_BYTES = 16 * 1024 * 1024
+# Files indexed per transaction while syncing. Their rows are looked up in
+# one query, old SQLite versions allow up to 999 bound parameters.
+_SEARCH_INDEX_BATCH_SIZE = 500
+_SEARCH_RESULT_LIMIT = 100
+# Regex searches stop scanning more files after this.
+_REGEX_SEARCH_SECONDS = 5
+# SQLite steps between the deadline checks of the searches with a deadline.
+_SEARCH_PROGRESS_STEPS = 1000
+# Matching lines shown for a file in the regex and grep searches.
+_SEARCH_MATCHES_PER_FILE = 5
+# Matching lines are cut to about this many characters in the snippets.
+_REGEX_SNIPPET_LENGTH = 200
+# Marks the matched terms in the snippets, escaped before they become html.
+_SNIPPET_START = '\ue000'
+_SNIPPET_END = '\ue001'
+
+
+def _is_indexable(path):
+  if os.path.splitext(path)[1].lower() in args.note_extensions:
+    return True
+  mime_type = mimetypes.guess_type(path)[0] or ''
+  return mime_type.startswith('text/') or mime_type in (
+      'application/javascript', 'application/json', 'application/xml')
+
+
+def _to_fts_query(query, prefix=False):
+  """Makes an FTS5 query matching all the words of a user query.
+
+  Every word is quoted, so that the FTS5 operators and punctuation in the
+  query are taken literally. With prefix set, the last word matches the
+  words starting with it too, eg. while it is typed.
+  """
+  fts_query = ' '.join(
+      '"%s"' % word.replace('"', '""') for word in query.split())
+  if prefix and fts_query:
+    fts_query += '*'
+  return fts_query
+
+
+_REPEAT_OPS = tuple(
+    getattr(sre_parse, name)
+    for name in ('MAX_REPEAT', 'MIN_REPEAT', 'POSSESSIVE_REPEAT')
+    if hasattr(sre_parse, name))
+
+
+def _regex_to_trigram_query(pattern):
+  """Makes an FTS5 trigram query for the files a regex can match in.
+
+  Every match of the regex contains the literal strings of 3 or more
+  characters it requires, so the files without them are skipped, as in the
+  trigram index of codesearch. Returns None if nothing is required, eg. for
+  .*, then all the files need to be scanned.
+  """
+  try:
+    return _trigram_query(sre_parse.parse(pattern))
+  except Exception:
+    return None
+
+
+def _trigram_query(items):
+  clauses = []
+  literal = []
+
+  def add_literal():
+    # Shorter ones have no trigram to look up.
+    if len(literal) >= 3:
+      clauses.append('"%s"' % ''.join(literal).replace('"', '""'))
+    del literal[:]
+
+  for op, arg in items:
+    if op is sre_parse.LITERAL:
+      literal.append(chr(arg))
+      continue
+    add_literal()
+    clause = None
+    if op is sre_parse.SUBPATTERN:
+      clause = _trigram_query(arg[-1])
+    elif op is sre_parse.BRANCH:
+      branches = [_trigram_query(branch) for branch in arg[1]]
+      # A branch without a clause can match anything.
+      if None not in branches:
+        clause = '(%s)' % ' OR '.join(branches)
+    elif op in _REPEAT_OPS and arg[0] >= 1:
+      clause = _trigram_query(arg[2])
+    if clause:
+      clauses.append(clause)
+  add_literal()
+  return ' AND '.join(clauses) or None
+
+
+def _has_nested_repeat(items, repeated=False):
+  """Whether a parsed regex has a variable repeat in a repeat, eg. (a+)+.
+
+  Those can backtrack exponentially on the lines they do not match, while
+  the fixed ones like (\\d{4}-)+ cannot.
+  """
+  for op, arg in items:
+    nested = repeated
+    if op is sre_parse.SUBPATTERN:
+      children = [arg[-1]]
+    elif op is sre_parse.BRANCH:
+      children = arg[1]
+    elif op in _REPEAT_OPS:
+      if arg[1] > 1:
+        if repeated and arg[0] != arg[1]:
+          return True
+        nested = True
+      children = [arg[2]]
+    else:
+      continue
+    if any(_has_nested_repeat(child, nested) for child in children):
       return True
+  return False
 
 
-def _get_file_paths_flat(path):
-  if is_ignored(path):
-    return 
-  leaves = []
-  root_dir = _get_root_dir(trailing_separator=False)
-  for root, dirs, files in os.walk(path, topdown=False):
-    for name in files:
-      leaves.append(
-        os.path.join(root, name).replace(root_dir, '')
-      )
-  return leaves
+def _match_to_snippet(content, start, end):
+  """Returns the lines of a match and their html with the match marked."""
+  line_start = content.rfind('\n', 0, start) + 1
+  line_end = content.find('\n', end)
+  if line_end == -1:
+    line_end = len(content)
+  # Cuts the long lines around the match.
+  line_start = max(line_start, start - _REGEX_SNIPPET_LENGTH // 2)
+  line_end = min(line_end, max(end, start + _REGEX_SNIPPET_LENGTH // 2))
+  snippet = content[line_start:line_end]
+  snippet_html = '%s<mark>%s</mark>%s' % (
+      html.escape(content[line_start:start]), html.escape(content[start:end]),
+      html.escape(content[end:line_end]))
+  return snippet, snippet_html
+
+
+def _snippet_to_html(snippet):
+  return html.escape(snippet).replace(_SNIPPET_START, '<mark>').replace(
+      _SNIPPET_END, '</mark>')
+
+
+class _SearchIndex(object):
+  """Full text index of the notes under a root dir in an SQLite FTS5 table.
+
+  The database is shared by the worker processes. Each thread has its own
+  connection. Files are indexed with their mtime_ns and size, so a sync only
+  reads the files changed since the last one.
+  """
+
+  def __init__(self, root_dir, db_path):
+    self.root_dir = root_dir
+    self.db_path = db_path
+    self._local = threading.local()
+    # Set once the index has all the notes, maybe from a previous run.
+    self.ready = threading.Event()
+
+    db = self._connect()
+    with db:
+      if db.execute('PRAGMA user_version').fetchone()[0] != _SEARCH_INDEX_SCHEMA:
+        db.execute('DROP TABLE IF EXISTS files')
+        db.execute('DROP TABLE IF EXISTS notes')
+        db.execute('DROP TABLE IF EXISTS trigrams')
+        db.execute('PRAGMA user_version = %d' % _SEARCH_INDEX_SCHEMA)
+      db.execute(
+          'CREATE TABLE IF NOT EXISTS files (id INTEGER PRIMARY KEY, '
+          'path TEXT UNIQUE NOT NULL, mtime_ns INTEGER, size INTEGER)')
+      # rowid of the notes is the id of the files. Prefixes of 2 and 3
+      # chars are indexed too, for the prefix queries while typing.
+      db.execute(
+          'CREATE VIRTUAL TABLE IF NOT EXISTS notes USING fts5('
+          'path, content, tokenize="unicode61 remove_diacritics 2", '
+          'prefix="2 3")')
+      # Trigram posting lists of the content for the regex searches, the
+      # content itself is read from the notes.
+      if _fts5_trigram_available:
+        db.execute(
+            'CREATE VIRTUAL TABLE IF NOT EXISTS trigrams USING fts5('
+            'content, content="notes", tokenize="trigram")')
+      # Bumped with every change of the notes, by any worker.
+      db.execute(
+          'CREATE TABLE IF NOT EXISTS generation (value INTEGER NOT NULL)')
+      if not db.execute('SELECT 1 FROM generation').fetchone():
+        db.execute('INSERT INTO generation (value) VALUES (0)')
+    if db.execute('SELECT 1 FROM files LIMIT 1').fetchone():
+      self.ready.set()
+
+  def _connect(self):
+    db = getattr(self._local, 'db', None)
+    if db is None:
+      # Waits for the writers of the other workers instead of failing.
+      db = sqlite3.connect(self.db_path, timeout=30)
+      db.execute('PRAGMA journal_mode=WAL')
+      db.execute('PRAGMA mmap_size = %d' % _SEARCH_INDEX_MMAP_BYTES)
+      self._local.db = db
+    return db
+
+  @contextlib.contextmanager
+  def _write_transaction(self, db):
+    """Transaction holding the write lock from its start.
+
+    So the rows read in it are still current when they are written. In a
+    deferred one another worker could index the same file in between.
+    """
+    with db:
+      db.execute('BEGIN IMMEDIATE')
+      yield
+
+  def _delete(self, db, file_id):
+    if _fts5_trigram_available:
+      # External content tables need the deleted content to find its trigrams.
+      row = db.execute(
+          'SELECT content FROM notes WHERE rowid = ?', (file_id,)).fetchone()
+      if row:
+        db.execute(
+            "INSERT INTO trigrams (trigrams, rowid, content) "
+            "VALUES ('delete', ?, ?)", (file_id, row[0]))
+    db.execute('DELETE FROM notes WHERE rowid = ?', (file_id,))
+    db.execute('DELETE FROM files WHERE id = ?', (file_id,))
+    db.execute('UPDATE generation SET value = value + 1')
+
+  def _index_file(self, db, workspace_path, known=None):
+    """Indexes the file if it changed, drops it if it is gone.
+
+    known is the (id, mtime_ns, size) row of the file, looked up if None.
+    """
+    if known is None:
+      known = db.execute(
+          'SELECT id, mtime_ns, size FROM files WHERE path = ?',
+          (workspace_path,)).fetchone()
+    path = self.root_dir + workspace_path
+    try:
+      stat = os.stat(path)
+    except OSError:
+      stat = None
+    if (stat is None or not _is_indexable(path) or
+        stat.st_size > _SEARCH_INDEX_MAX_BYTES):
+      if known:
+        self._delete(db, known[0])
+      return
+    if known and known[1:] == (stat.st_mtime_ns, stat.st_size):
+      return
+
+    with open(path, 'r', encoding='utf-8', errors='replace') as f:
+      content = f.read()
+    if known:
+      self._delete(db, known[0])
+    file_id = db.execute(
+        'INSERT INTO files (path, mtime_ns, size) VALUES (?, ?, ?)',
+        (workspace_path, stat.st_mtime_ns, stat.st_size)).lastrowid
+    db.execute('INSERT INTO notes (rowid, path, content) VALUES (?, ?, ?)',
+               (file_id, workspace_path, content))
+    if _fts5_trigram_available:
+      db.execute('INSERT INTO trigrams (rowid, content) VALUES (?, ?)',
+                 (file_id, content))
+    db.execute('UPDATE generation SET value = value + 1')
+
+  def _files_under(self, db, workspace_path):
+    # Paths starting with workspace_path + '/', '0' is the next character.
+    prefix = workspace_path.rstrip(os.sep)
+    return db.execute(
+        'SELECT path, id, mtime_ns, size FROM files '
+        'WHERE path >= ? AND path < ?', (prefix + '/', prefix + '0')).fetchall()
+
+  def update(self, path):
+    """Reindexes a file or a dir changed, created or removed on the disk."""
+    workspace_path = _get_workspace_path(path, self.root_dir)
+    db = self._connect()
+    with self._write_transaction(db):
+      # Whatever was indexed under it, eg. if it was a dir before.
+      for row in self._files_under(db, workspace_path):
+        self._index_file(db, row[0], row[1:])
+      if not os.path.isdir(path):
+        self._index_file(db, workspace_path)
+        return
+      for dir_path, dir_names, file_names in os.walk(path):
+        dir_names[:] = [dir_name for dir_name in dir_names
+                        if not is_ignored(os.path.join(dir_path, dir_name))]
+        for file_name in file_names:
+          file_path = os.path.join(dir_path, file_name)
+          if not is_ignored(file_path):
+            self._index_file(
+                db, _get_workspace_path(file_path, self.root_dir))
+
+  def sync(self, file_paths):
+    """Brings the index in line with the given workspace paths of the files.
+
+    Other workers may sync or update the same files meanwhile, so the rows
+    are read again in each transaction.
+    """
+    db = self._connect()
+    with self._write_transaction(db):
+      known = dict(db.execute('SELECT path, id FROM files'))
+      for path in known.keys() - set(file_paths):
+        self._delete(db, known[path])
+    for i in range(0, len(file_paths), _SEARCH_INDEX_BATCH_SIZE):
+      batch = file_paths[i:i + _SEARCH_INDEX_BATCH_SIZE]
+      # Committed in batches, so that searches see the progress.
+      with self._write_transaction(db):
+        known = {row[0]: row[1:] for row in db.execute(
+            'SELECT path, id, mtime_ns, size FROM files WHERE path IN (%s)'
+            % ', '.join('?' * len(batch)), batch)}
+        for path in batch:
+          self._index_file(db, path, known.get(path, False))
+    self.ready.set()
+
+  def generation(self):
+    """Returns a number which changes whenever the indexed notes change."""
+    return self._connect().execute(
+        'SELECT value FROM generation').fetchone()[0]
+
+  def search(self, query, limit=_SEARCH_RESULT_LIMIT, prefix=False,
+             snippets=True):
+    """Returns the best matching files first, ranked by bm25.
+
+    See _to_fts_query for prefix. Snippets cost more than the search itself,
+    without snippets set the matches are left empty for add_snippets.
+    """
+    fts_query = _to_fts_query(query, prefix)
+    if not fts_query:
+      return []
+    rows = self._connect().execute(
+        'SELECT path, bm25(notes, 2.0, 1.0) FROM notes WHERE notes MATCH ? '
+        'ORDER BY 2 LIMIT ?', (fts_query, limit)).fetchall()
+    results = [{'file': path, 'score': -rank, 'matches': []}
+               for path, rank in rows]
+    if snippets:
+      self.add_snippets(query, results, prefix)
+    return results
+
+  def add_snippets(self, query, results, prefix=False):
+    """Fills the empty matches of the search results with their snippets."""
+    paths = [result['file'] for result in results if not result['matches']]
+    if not paths:
+      return
+    rows = self._connect().execute(
+        'SELECT path, snippet(notes, 1, ?, ?, ?, 16) FROM notes '
+        'WHERE notes MATCH ? AND rowid IN ('
+        'SELECT id FROM files WHERE path IN (%s))' % ', '.join(
+            '?' * len(paths)),
+        [_SNIPPET_START, _SNIPPET_END, '...', _to_fts_query(query, prefix)] +
+        paths).fetchall()
+    snippets = dict(rows)
+    for result in results:
+      snippet = snippets.get(result['file'])
+      if not result['matches'] and snippet is not None:
+        result['matches'] = [{
+            'snippet': snippet.replace(_SNIPPET_START, '').replace(
+                _SNIPPET_END, ''),
+            'snippet_html': _snippet_to_html(snippet),
+        }]
+
+  def iter_search(self, query, limit=_SEARCH_RESULT_LIMIT, prefix=False,
+                  seconds=None):
+    """Yields the results of search, returns a note if it ran out of time.
+
+    Results come without snippets. With seconds set, the query is
+    interrupted after that long and nothing is yielded.
+    """
+    deadline = None if seconds is None else time.time() + seconds
+    db = self._connect()
+    if deadline is not None:
+      db.set_progress_handler(
+          lambda: time.time() > deadline, _SEARCH_PROGRESS_STEPS)
+    try:
+      results = self.search(query, limit, prefix, snippets=False)
+    except sqlite3.OperationalError:
+      if deadline is None or time.time() <= deadline:
+        raise
+      return 'stopped after %g seconds' % seconds
+    finally:
+      db.set_progress_handler(None, 0)
+    yield from results
+    return None
+
+  def search_regex(self, regex, limit=_SEARCH_RESULT_LIMIT,
+                   seconds=_REGEX_SEARCH_SECONDS):
+    """Returns the files matching a compiled regex and whether all are seen.
+
+    See iter_search_regex.
+    """
+    results = []
+    search = self.iter_search_regex(regex, seconds)
+    while len(results) < limit:
+      try:
+        results.append(next(search))
+      except StopIteration as stop:
+        return results, stop.value is None
+    search.close()
+    return results, True
+
+  def iter_search_regex(self, regex, seconds=_REGEX_SEARCH_SECONDS):
+    """Yields the files matching a compiled regex as they are found.
+
+    Only the files having the literals required by the regex, found through
+    the trigram index, are scanned. Files are in path order, with their first
+    few matching lines. The regex runs in the grep processes, not in the
+    request thread. Scanning stops after the given seconds, then a note about
+    it is returned.
+    """
+    db = self._connect()
+    trigram_query = (
+        _regex_to_trigram_query(regex.pattern)
+        if _fts5_trigram_available else None)
+    if trigram_query:
+      rows = db.execute(
+          'SELECT id FROM files WHERE id IN ('
+          'SELECT rowid FROM trigrams WHERE trigrams MATCH ?) ORDER BY path',
+          (trigram_query,)).fetchall()
+    else:
+      rows = db.execute('SELECT id FROM files ORDER BY path').fetchall()
+    file_ids = [file_id for file_id, in rows]
+
+    deadline = time.time() + seconds
+    pool = _get_grep_pool()
+    futures = [
+        pool.submit(_grep_index_rows, self.db_path, regex.pattern,
+                    regex.flags, file_ids[i:i + _GREP_SHARD_FILES], deadline)
+        for i in range(0, len(file_ids), _GREP_SHARD_FILES)]
+    try:
+      for future in futures:
+        done, _ = concurrent.futures.wait(
+            [future], timeout=max(0, deadline - time.time()))
+        if not done:
+          return 'stopped after %g seconds' % seconds
+        for path, matches in future.result():
+          yield {'file': path, 'matches': matches}
+    finally:
+      # Running shards can't be cancelled, they stop at the deadline.
+      for future in futures:
+        future.cancel()
+    return None
+
+
+_fts5_available = _is_fts5_available()
+_fts5_trigram_available = _is_fts5_available('trigram')
+# Absolute root dir => _SearchIndex.
+_search_indexes = {}
+_search_indexes_lock = threading.Lock()
+# All the index writes of this process are done in this thread.
+_search_index_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+
+def _run_search_index_task(fn, *args):
+  try:
+    fn(*args)
+  except Exception:
+    logging.error('Search index task failed', exc_info=True)
+
+
+def _get_search_index(root_dir):
+  """Returns the search index of the root dir, syncs it on the first call."""
+  root_dir = os.path.abspath(root_dir)
+  with _search_indexes_lock:
+    search_index = _search_indexes.get(root_dir)
+    if search_index is not None:
+      return search_index
+    search_dir = os.path.join(_PERVANE_CONFIG_DIR, 'search')
+    os.makedirs(search_dir, exist_ok=True)
+    search_index = _SearchIndex(root_dir, os.path.join(
+        search_dir,
+        hashlib.sha1(root_dir.encode('utf-8')).hexdigest()[:16] + '.sqlite'))
+    _search_indexes[root_dir] = search_index
+  _sync_search_index(search_index)
+  return search_index
+
+
+def _sync_search_index(search_index):
+  tree_index = _get_tree_index(search_index.root_dir)
+  _search_index_executor.submit(
+      _run_search_index_task, search_index.sync, list(tree_index.file_paths()))
+
+
+# Bumped with every change pervane makes or the filesystem events report, so
+# that the cached results of the grep backends are not served after it. Shared
+# by the workers like the tree generation, the results are in the shared cache.
+if args.cache_type == 'redis':
+  _content_generation = _CacheGeneration(cache, 'content_generation')
+else:
+  _content_generation = _SharedGeneration(
+      os.path.join(_PERVANE_CONFIG_DIR, 'content_generation'))
+
+
+def _update_search_index(*paths, root_dir=None):
+  """Reindexes the given absolute paths in the background.
+
+  Skipped if the search index of the root dir isn't opened yet, it is synced
+  when it is opened.
+  """
+  _content_generation.bump()
+  if root_dir is None:
+    root_dir = _get_root_dir(trailing_separator=False)
+  search_index = _search_indexes.get(os.path.abspath(root_dir))
+  if search_index is None:
+    return
+  for path in paths:
+    if path:
+      _search_index_executor.submit(
+          _run_search_index_task, search_index.update, path)
 
 
 def _get_file_mode(path):
@@ -403,8 +1948,7 @@ def _get_file_mode(path):
   return 'text/html'
 
 
-def _get_file_mod_time(path):
-  mod_secs = os.path.getmtime(path)
+def _format_mod_time(mod_secs):
   return datetime.datetime.fromtimestamp(mod_secs).strftime('%Y-%m-%d %H:%M:%S')
 
 
@@ -489,12 +2033,190 @@ def _get_new_node_name(new_node_name):
   return (None, file_name, None)
 
 
+# Responses smaller than this aren't worth gzipping.
+_GZIP_MIN_BYTES = 1024
+
+
 def _failure_json(err):
   if err == 'success':
     raise ValueError
   return jsonify({'result' : err})
 
 
+def _get_file_version(stat):
+  """Strong validator of a file from its stat result.
+
+  Pervane writes through AtomicFile which replaces the inode, so the inode
+  changes even if mtime and size stay the same.
+  """
+  return '%x-%x-%x' % (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+
+
+# Media urls carrying the current version are cached for a year.
+_MEDIA_MAX_AGE = 365 * 24 * 3600
+
+
+def _get_media_url(workspace_path, version, prefix='/_img'):
+  """Url streaming the file at workspace path, pinned to its version."""
+  return '%s%s?v=%s' % (
+      prefix, urllib.parse.quote('/' + workspace_path.lstrip('/')), version)
+
+
+def _is_gzip_accepted(body):
+  return (len(body) >= _GZIP_MIN_BYTES and
+          'gzip' in request.headers.get('Accept-Encoding', ''))
+
+
+def _add_validators(response, etag, last_modified=None):
+  response.set_etag(etag)
+  if last_modified is not None:
+    response.headers['Last-Modified'] = http_date(last_modified)
+  # Browsers may keep it but need to revalidate.
+  response.headers['Cache-Control'] = 'no-cache'
+  response.vary.add('Accept-Encoding')
+  return response
+
+
+def _not_modified_response(etag, last_modified=None):
+  """Returns a 304 response if the client has this version, None otherwise.
+
+  last_modified is in seconds since epoch, like the mtimes.
+
+  Lets the handlers answer If-None-Match and If-Modified-Since before reading
+  anything. Both the plain and the gzipped ETag are accepted.
+  """
+  if last_modified is not None:
+    last_modified = datetime.datetime.fromtimestamp(
+        last_modified, tz=datetime.timezone.utc)
+  for candidate_etag in (etag, etag + '.gz'):
+    if not is_resource_modified(request.environ, etag=candidate_etag,
+                                last_modified=last_modified):
+      return _add_validators(
+          app.response_class(status=304), candidate_etag, last_modified)
+  return None
+
+
+def _cacheable_response(body, etag, mimetype='application/json',
+                        last_modified=None):
+  """Makes a response validated by the given ETag and Last-Modified time.
+
+  Matching If-None-Match or If-Modified-Since gets a 304. Large bodies are
+  gzipped when the client accepts it, such responses get their own ETag.
+  """
+  response = _not_modified_response(etag, last_modified)
+  if response is not None:
+    return response
+
+  if _is_gzip_accepted(body):
+    etag += '.gz'
+    response = app.response_class(_gzip(body, etag), mimetype=mimetype)
+    response.headers['Content-Encoding'] = 'gzip'
+  else:
+    response = app.response_class(body, mimetype=mimetype)
+  return _add_validators(response, etag, last_modified)
+
+
+# ETag => gzipped body of the last few large responses, eg. the tree.
+_gzip_cache = collections.OrderedDict()
+_GZIP_CACHE_SIZE = 8
+_gzip_cache_lock = threading.Lock()
+
+
+def _gzip(body, etag):
+  with _gzip_cache_lock:
+    compressed = _gzip_cache.get(etag)
+    if compressed is not None:
+      _gzip_cache.move_to_end(etag)
+      return compressed
+  compressed = gzip.compress(body.encode('utf-8'), compresslevel=6)
+  with _gzip_cache_lock:
+    _gzip_cache[etag] = compressed
+    if len(_gzip_cache) > _GZIP_CACHE_SIZE:
+      _gzip_cache.popitem(last=False)
+  return compressed
+
+
+class _ContentCache(object):
+  """Least recently used contents of the text files within a byte budget.
+
+  An entry is only returned while the file is at the version it was read or
+  written at, see _get_file_version, so a change by any process or editor is
+  a miss. Files larger than 1/16 of the budget aren't kept.
+  """
+
+  def __init__(self, max_bytes):
+    self.max_bytes = max_bytes
+    self.bytes = 0
+    self.hits = 0
+    self.misses = 0
+    # Real path => (version, content, bytes).
+    self._entries = collections.OrderedDict()
+    self._lock = threading.Lock()
+
+  def get(self, path, version):
+    with self._lock:
+      entry = self._entries.get(path)
+      if entry is None or entry[0] != version:
+        self.misses += 1
+        return None
+      self._entries.move_to_end(path)
+      self.hits += 1
+      return entry[1]
+
+  def put(self, path, version, content):
+    size = sys.getsizeof(content)
+    with self._lock:
+      self._pop(path)
+      if size > self.max_bytes // 16:
+        return
+      self._entries[path] = (version, content, size)
+      self.bytes += size
+      while self.bytes > self.max_bytes:
+        _, (_, _, evicted_size) = self._entries.popitem(last=False)
+        self.bytes -= evicted_size
+
+  def remove(self, path):
+    with self._lock:
+      self._pop(path)
+
+  def _pop(self, path):
+    entry = self._entries.pop(path, None)
+    if entry is not None:
+      self.bytes -= entry[2]
+
+  def stats(self):
+    with self._lock:
+      return {
+          'hits': self.hits,
+          'misses': self.misses,
+          'entries': len(self._entries),
+          'bytes': self.bytes,
+          'max_bytes': self.max_bytes,
+      }
+
+
+_content_cache = _ContentCache(args.content_cache_bytes)
+
+
+def _read_text_file(path, stat=None):
+  """Returns the content of the text file at path and its stat.
+
+  Comes from _content_cache if the file is still at the cached version. stat
+  is the one of the path if the caller has it already.
+  """
+  if stat is None:
+    stat = os.stat(path)
+  content = _content_cache.get(path, _get_file_version(stat))
+  if content is not None:
+    return content, stat
+  with open(path, 'r') as f:
+    # Stat of the opened file, so the version matches the content read.
+    stat = os.fstat(f.fileno())
+    content = f.read()
+  _content_cache.put(path, _get_file_version(stat), content)
+  return content, stat
+
+
 @app.context_processor
 def inject_dict_for_all_templates():
   return dict(
@@ -569,11 +2291,11 @@ def front_page_handler():
     os.mkdir(root_dir)
     
   return render_template(
-      'index.html', tree=make_tree(root_dir),
+      'index.html', tree=make_tree(root_dir, args.tree_depth),
+      tree_depth=args.tree_depth,
       html_content=args.front_page_message,
       note_extensions=args.note_extensions,
       mime_type='',
-      file_paths_flat=json.dumps(_get_file_paths_flat(root_dir)),
       root_dir=root_dir,
       current_user=current_user,
       debug=args.debug,
@@ -600,39 +2322,153 @@ def api_get_file_handler():
             requested_path)})
 
   try:
+    if mime_type.startswith('image/') or mime_type.startswith('video/'):
+      # Media isn't inlined, the client loads it from the url which is
+      # streamed by static_file_handler.
+      stat = os.stat(path)
+      version = _get_file_version(stat)
+      return _cacheable_response(
+          json.dumps({
+            'result': 'success',
+            'url': _get_media_url(requested_path, version),
+            'mime_type': mime_type,
+            'size': stat.st_size,
+            'version': version,
+            'mod_time': _format_mod_time(stat.st_mtime),
+          }), version, last_modified=stat.st_mtime)
+
     html_content = ''
     # Text is our main interest.
+    stat = os.stat(path)
     if mime_type.startswith('text/'):
-      with open(path, 'r') as f:
-        html_content = f.read()
-    elif mime_type.startswith('image/'):
-      with open(path, 'rb') as f:
-        html_content = base64.b64encode(f.read()).decode('ascii')
-
-    # TODO [basri] mime_type could be video or js here. we return nothing in this case?
-    mod_time = _get_file_mod_time(path)
-
-    return jsonify({
-      'result': 'success',
-      'content': html_content,
-      'mod_time': mod_time
-    })
+      not_modified = _not_modified_response(
+          _get_file_version(stat), stat.st_mtime)
+      if not_modified is not None:
+        return not_modified
+      html_content, stat = _read_text_file(path, stat)
+
+    mod_time = _format_mod_time(stat.st_mtime)
+
+    return _cacheable_response(
+        json.dumps({
+          'result': 'success',
+          'content': html_content,
+          'mod_time': mod_time
+        }), _get_file_version(stat), last_modified=stat.st_mtime)
   except Exception as e:
     logging.error('There is an error while reading: %r', path, exc_info=True)
     # Don't leak the absolute path.
     return _failure_json(('Reading %s failed' % requested_path))
 
 
+@app.route('/api/cache_stats')
+@login_required
+def api_cache_stats_handler():
+  """Hit and miss counts of the caches of this worker process, for sizing."""
+  return jsonify({
+      'result': 'success',
+      'content': {
+          'content_cache': _content_cache.stats(),
+      },
+  })
+
+
 @app.route('/api/get_tree')
 @login_required
 def api_get_tree_handler():
+  """Returns the file tree.
+
+  Optional f param is the workspace path of a dir to return only its part of
+  the tree. Optional depth param limits the levels returned, see
+  _TreeIndex.subtree.
+  """
   root_dir = _get_root_dir()
   if not os.path.exists(root_dir):
     logging.info('Initializing the root dir')
 
+  tree_index = _get_tree_index(root_dir)
+  requested_path = _get_request_param('f') or os.sep
+  try:
+    depth = int(_get_request_param('depth') or 0)
+  except ValueError:
+    return _failure_json('depth should be a number')
+
+  if requested_path == os.sep and depth <= 0:
+    return _cacheable_response(
+        tree_index.response_json(), tree_index.response_etag())
+
+  path, err = _get_real_path(requested_path)
+  if err:
+    return _failure_json('invalid path: ' + err)
+
+  subtree = tree_index.subtree(
+      _get_workspace_path(path, tree_index.root_dir), depth)
+  if subtree is None:
+    return _failure_json('No such directory %s' % requested_path)
+  body = json.dumps({
+      'result': 'success',
+      'content': subtree
+  })
+  return _cacheable_response(
+      body, hashlib.sha1(body.encode('utf-8')).hexdigest()[:16])
+
+
+@app.route('/api/file_paths')
+@login_required
+def api_file_paths_handler():
+  """Returns the flat list of the file paths for the quick search.
+
+  The response carries the version of the list. With the since param set to
+  a version the client has, only the added and removed paths are returned
+  when this worker knows the changes since then, otherwise the full list.
+  """
+  tree_index = _get_tree_index(_get_root_dir())
+  version, file_paths = tree_index.file_paths_version()
+  since = _get_request_param('since')
+  changes = tree_index.file_paths_changes(since) if since else None
+  if changes is None:
+    body = json.dumps({
+        'result': 'success',
+        'version': version,
+        'content': file_paths,
+    })
+    return _cacheable_response(body, version)
+
+  added, removed = changes
+  body = json.dumps({
+      'result': 'success',
+      'version': version,
+      'since': since,
+      'added': added,
+      'removed': removed,
+  })
+  return _cacheable_response(body, '%s-%s' % (since, version))
+
+
+@app.route('/api/find_file')
+@login_required
+def api_find_file_handler():
+  """Fuzzy searches the file paths for the quick open.
+
+  Returns the best matches of the q param, up to the optional limit, ranked
+  as fuzzysort does with the path, the score and the matched indexes.
+  """
+  query = _get_request_param('q')
+  try:
+    limit = min(int(_get_request_param('limit') or _FIND_FILE_LIMIT),
+                _FIND_FILE_LIMIT_MAX)
+  except ValueError:
+    return _failure_json('limit should be a number')
+  if not query:
+    return jsonify({'result': 'success', 'content': []})
+
+  tree_index = _get_tree_index(_get_root_dir())
   return jsonify({
       'result': 'success',
-      'content': make_tree(root_dir)
+      'content': [
+          {'target': path, 'score': score, 'indexes': indexes}
+          for score, path, indexes in tree_index.file_names.find(query, limit)
+      ],
   })
 
 
@@ -649,40 +2485,397 @@ def api_get_content_handler():
   file_mode = _get_file_mode(requested_path)
 
   try:
-    with open(path, 'r') as f:
-      content = f.read()
-      mod_time = _get_file_mod_time(path)
+    stat = os.stat(path)
+    not_modified = _not_modified_response(
+        _get_file_version(stat), stat.st_mtime)
+    if not_modified is not None:
+      return not_modified
+    if stat.st_size > args.large_file_bytes:
+      # Too large for the editor, the client reads it in windows with
+      # /api/get_content_window instead.
+      version = _get_file_version(stat)
+      return _cacheable_response(
+          json.dumps({
+              'result': 'success',
+              'content': '',
+              'large': True,
+              'size': stat.st_size,
+              'file_mode': file_mode,
+              'mod_time': _format_mod_time(stat.st_mtime),
+              'version': version,
+          }), version, last_modified=stat.st_mtime)
+    content, stat = _read_text_file(path, stat)
+    version = _get_file_version(stat)
+    mod_time = _format_mod_time(stat.st_mtime)
+
+    return _cacheable_response(
+        json.dumps({
+            'result': 'success',
+            'content': content,
+            'file_mode': file_mode,
+            'mod_time': mod_time,
+            'version': version,
+        }), version, last_modified=stat.st_mtime)
+  except Exception as e:
+    logging.error('There is an error while reading: %r', path, exc_info=True)
+    # Don't leak the absolute path.
+    return _failure_json(('Reading %s failed' % requested_path))
 
-    return jsonify({
-        'result': 'success',
-        'content': content,
-        'file_mode': file_mode,
-        'mod_time': mod_time
-    })
+
+# Default and largest numbers of lines and bytes of a windowed read.
+_WINDOW_LINES = 1000
+_WINDOW_MAX_LINES = 10000
+_WINDOW_BYTES = 256 * 1024
+_WINDOW_MAX_BYTES = 4 * 1024 * 1024
+_LINE_INDEX_BLOCK = 64 * 1024
+_LINE_INDEX_CACHE_SIZE = 16
+# Real path => (version, _LineIndex) of the recently windowed files.
+_line_indexes = collections.OrderedDict()
+_line_indexes_lock = threading.Lock()
+
+
+class _LineIndex(object):
+  """Finds where the lines of a file start, without keeping every offset.
+
+  Has the number of newlines before each _LINE_INDEX_BLOCK bytes, so a line
+  is found by scanning one block at most. Built in one pass over the mmap'ed
+  file.
+  """
+
+  def __init__(self, data):
+    self.size = len(data)
+    self._block_newlines = [0]
+    newlines = 0
+    for start in range(0, self.size, _LINE_INDEX_BLOCK):
+      newlines += data[start:start + _LINE_INDEX_BLOCK].count(b'\n')
+      self._block_newlines.append(newlines)
+    self._newlines = newlines
+    # The last line may not end with a newline.
+    self.line_count = newlines + (
+        1 if self.size and data[self.size - 1] != ord('\n') else 0)
+
+  def line_offset(self, data, line):
+    """Byte offset of the start of the 0 based line, the size past the end."""
+    if line <= 0:
+      return 0
+    if line > self._newlines:
+      return self.size
+    # The block with the newline ending the previous line.
+    block = bisect.bisect_left(self._block_newlines, line) - 1
+    position = block * _LINE_INDEX_BLOCK
+    for _ in range(line - self._block_newlines[block]):
+      position = data.find(b'\n', position) + 1
+    return position
+
+
+def _get_line_index(path, version, data):
+  with _line_indexes_lock:
+    entry = _line_indexes.get(path)
+    if entry is not None and entry[0] == version:
+      _line_indexes.move_to_end(path)
+      return entry[1]
+  line_index = _LineIndex(data)
+  with _line_indexes_lock:
+    _line_indexes[path] = (version, line_index)
+    _line_indexes.move_to_end(path)
+    while len(_line_indexes) > _LINE_INDEX_CACHE_SIZE:
+      _line_indexes.popitem(last=False)
+  return line_index
+
+
+def _read_content_window(path, line=None, lines=_WINDOW_LINES, offset=0,
+                         length=_WINDOW_BYTES):
+  """Reads a part of the text file at path through mmap.
+
+  With line set, that many lines from the 0 based line are read, otherwise
+  length bytes from offset. Either way it is cut at _WINDOW_MAX_BYTES, bytes
+  of the characters split at the edges are replaced. Line offsets come from
+  a _LineIndex kept per file version.
+
+  A line cut at the end isn't in the line_count and truncated is set. Its
+  rest is read with the same line and offset set to the end_offset.
+
+  Returns a dict of the content and where it is in the file.
+  """
+  with open(path, 'rb') as f:
+    stat = os.fstat(f.fileno())
+    version = _get_file_version(stat)
+    # Empty files can't be mmap'ed.
+    data = (mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            if stat.st_size else b'')
+  try:
+    if line is not None:
+      line_index = _get_line_index(path, version, data)
+      # The offset is in the line if it continues a truncated window.
+      offset = min(max(line_index.line_offset(data, line), offset),
+                   stat.st_size)
+      end_offset = line_index.line_offset(data, line + lines)
+    else:
+      offset = min(offset, stat.st_size)
+      end_offset = min(offset + length, stat.st_size)
+    end_offset = min(end_offset, offset + _WINDOW_MAX_BYTES)
+    content = data[offset:end_offset]
+  finally:
+    if stat.st_size:
+      data.close()
+
+  window = {
+      'version': version,
+      'size': stat.st_size,
+      'offset': offset,
+      'end_offset': end_offset,
+  }
+  if line is not None:
+    # Only the last line of the file may end without a newline.
+    truncated = (
+        bool(content) and not content.endswith(b'\n') and
+        end_offset < stat.st_size)
+    window['line'] = line
+    window['line_count'] = content.count(b'\n') + (
+        1 if content and not content.endswith(b'\n') and not truncated else 0)
+    window['truncated'] = truncated
+    window['total_lines'] = line_index.line_count
+  window['content'] = content.decode('utf-8', 'replace')
+  return window
+
+
+@app.route('/api/get_content_window')
+@login_required
+def api_get_content_window_handler():
+  """Part of a text file, for the ones too large to be sent whole.
+
+  Lines from the 0 based line param, up to lines of them, from the offset
+  param in that line if it is set. With no line param, up to length bytes
+  from the offset param. See _read_content_window.
+  """
+  requested_path = _get_request_param('f')
+  path, err = _get_real_path(requested_path)
+  if err:
+    return _failure_json('invalid path: ' + err)
+  try:
+    line = _get_request_param('line')
+    line = max(int(line), 0) if line else None
+    lines = min(max(int(_get_request_param('lines') or _WINDOW_LINES), 1),
+                _WINDOW_MAX_LINES)
+    offset = max(int(_get_request_param('offset') or 0), 0)
+    length = min(max(int(_get_request_param('length') or _WINDOW_BYTES), 1),
+                 _WINDOW_MAX_BYTES)
+  except ValueError:
+    return _failure_json('line, lines, offset and length should be numbers')
+
+  try:
+    window = _read_content_window(path, line, lines, offset, length)
   except Exception as e:
     logging.error('There is an error while reading: %r', path, exc_info=True)
     # Don't leak the absolute path.
     return _failure_json(('Reading %s failed' % requested_path))
+  window['result'] = 'success'
+  window['file_mode'] = _get_file_mode(requested_path)
+  return jsonify(window)
+
+
+_WRITE_LOCK_PATH = os.path.join(_PERVANE_CONFIG_DIR, 'write.lock')
+# Used instead of the lock file where flock is not available.
+_write_lock = threading.Lock()
+
+
+@contextlib.contextmanager
+def _locked_for_write():
+  """Serializes the file writes of all the threads and worker processes.
+
+  The lock file is in the config dir rather than the written file since
+  AtomicFile replaces the inode of the file on every write.
+  """
+  if not fcntl:
+    with _write_lock:
+      yield
+    return
+  # A new file description each time, so threads exclude each other too.
+  with open(_WRITE_LOCK_PATH, 'ab') as f:
+    fcntl.flock(f, fcntl.LOCK_EX)
+    yield
+
+
+class _WriteCoalescer(object):
+  """Remembers the recent writes of the files, used under the write lock.
+
+  Drops the writes with sequence numbers older than the last one of the same
+  client, eg. an autosave overtaken by a later one. Writes of the content the
+  file already has are not done again, as long as the file is still at the
+  version of the last write.
+
+  It is per worker process, the writes reaching another worker are still
+  checked against their base version.
+  """
+
+  def __init__(self, size):
+    self._size = size
+    # Real path => {'seqs': {client id => seq}, 'digest', 'version'}.
+    self._writes = collections.OrderedDict()
+
+  def _get(self, path):
+    write = self._writes.pop(path, None) or {
+        'seqs': {}, 'digest': None, 'version': None}
+    self._writes[path] = write
+    while len(self._writes) > self._size:
+      self._writes.popitem(last=False)
+    return write
+
+  def is_stale(self, path, client_id, seq):
+    """Records seq as the last one of the client, unless it is older."""
+    if not client_id or seq is None:
+      return False
+    seqs = self._get(path)['seqs']
+    if seq <= seqs.get(client_id, -1):
+      return True
+    seqs[client_id] = seq
+    return False
+
+  def is_unchanged(self, path, digest, current_version):
+    write = self._writes.get(path)
+    return (write is not None and write['digest'] == digest and
+            write['version'] == current_version)
+
+  def written(self, path, digest, version):
+    write = self._get(path)
+    write['digest'] = digest
+    write['version'] = version
+
+
+_WRITE_COALESCER_SIZE = 256
+_write_coalescer = _WriteCoalescer(_WRITE_COALESCER_SIZE)
+
+
+def _get_path_version(path):
+  """Version of the file at path as in _get_file_version, None if missing."""
+  try:
+    return _get_file_version(os.stat(path))
+  except FileNotFoundError:
+    return None
+
+
+def _apply_patch(content, patch, base_length=None):
+  """Applies ranged edits to content, returns None if they don't fit it.
+
+  patch is a list of {start, end, text} edits replacing content[start:end]
+  with text, sorted and not overlapping. Offsets count UTF-16 code units like
+  the indexes of the JS strings, so they are applied on the UTF-16 encoding.
+  base_length is the length the client has for content, in the same units.
+  """
+  encoded = content.encode('utf-16-le', 'surrogatepass')
+  if base_length is not None and base_length * 2 != len(encoded):
+    return None
+  parts = []
+  position = 0
+  try:
+    for edit in patch:
+      start, end = int(edit['start']) * 2, int(edit['end']) * 2
+      if not position <= start <= end <= len(encoded):
+        return None
+      parts.append(encoded[position:start])
+      parts.append(edit['text'].encode('utf-16-le', 'surrogatepass'))
+      position = end
+  except (AttributeError, KeyError, TypeError, ValueError):
+    return None
+  parts.append(encoded[position:])
+  try:
+    return b''.join(parts).decode('utf-16-le')
+  except UnicodeDecodeError:
+    # Unpaired surrogates.
+    return None
+
+
+def _conflict_response(current_version):
+  return jsonify({
+      'result': 'conflict',
+      'version': current_version,
+  }), 409
 
 
 @app.route('/api/update', methods=['POST'])
 @login_required
 def api_update_handler():
-  # TODO [basri] is it a good idea to strip spaces from user's own text?
-  updated_content = _get_request_json('updated_content')
-  if not updated_content:
-    return _failure_json('File content is empty')
+  """Writes the content of a file.
+
+  With base_version set to the version the client has, the file is written
+  only if it is still at that version. Otherwise it is a 409 with the current
+  version, so that the edits of the other tabs are not lost silently.
+
+  Instead of the whole updated_content, a patch against base_version can be
+  sent, see _apply_patch. If it doesn't apply, the reply is patch_failed and
+  the client should send the whole content.
 
+  Clients can number their writes with client_id and seq, then a write older
+  than the last one is dropped as stale, see _WriteCoalescer.
+  """
   requested_path = _get_request_json('file_path')
   path, err = _get_real_path(requested_path)
   if err:
     return _failure_json(err)
+  # null is no base version too.
+  base_version = request.json.get('base_version') or ''
+  if not isinstance(base_version, str):
+    return _failure_json('base_version should be a string')
+  base_version = base_version.strip()
+
+  patch = request.json.get('patch')
+  if patch is None:
+    # TODO [basri] is it a good idea to strip spaces from user's own text?
+    updated_content = _get_request_json('updated_content')
+    if not updated_content:
+      return _failure_json('File content is empty')
+  elif not base_version:
+    return _failure_json('A patch needs a base_version')
+  client_id = _get_request_json('client_id')
+  seq = request.json.get('seq')
+  if seq is not None and not isinstance(seq, int):
+    return _failure_json('seq should be a number')
 
   try:
-    with AtomicFile(path, 'w') as f:
-      f.write(updated_content)
-      
-    return jsonify({'result': 'success'})
+    with _locked_for_write():
+      if _write_coalescer.is_stale(path, client_id, seq):
+        return jsonify({'result': 'stale', 'version': _get_path_version(path)})
+      if patch is not None:
+        try:
+          current_content, stat = _read_text_file(path)
+        except FileNotFoundError:
+          return _conflict_response(None)
+        current_version = _get_file_version(stat)
+        if current_version != base_version:
+          return _conflict_response(current_version)
+        updated_content = _apply_patch(
+            current_content, patch, request.json.get('base_length'))
+        if updated_content is None:
+          return jsonify({'result': 'patch_failed'}), 422
+        # Same with the whole content uploads.
+        updated_content = updated_content.strip()
+        if not updated_content:
+          return _failure_json('File content is empty')
+
+      digest = hashlib.sha1(
+          updated_content.encode('utf-8', 'surrogatepass')).hexdigest()
+      current_version = _get_path_version(path)
+      if (_write_coalescer.is_unchanged(path, digest, current_version) and
+          base_version in ('', current_version)):
+        return jsonify({'result': 'success', 'version': current_version})
+
+      with AtomicFile(path, 'w') as f:
+        f.write(updated_content)
+        # Checked after the temp file is written, right before the rename.
+        current_version = _get_path_version(path)
+        if base_version and current_version != base_version:
+          f.discard()
+          return _conflict_response(current_version)
+      version = _get_path_version(path)
+      _write_coalescer.written(path, digest, version)
+      if '\r' in updated_content:
+        # Reading it back turns the line endings into \n.
+        _content_cache.remove(path)
+      else:
+        _content_cache.put(path, version, updated_content)
+    _update_search_index(path)
+
+    return jsonify({'result': 'success', 'version': version})
   except Exception as e:
     logging.error('There is an error while writing: %r', path, exc_info=True)
     # Don't leak the absolute path.
@@ -721,6 +2914,7 @@ def add_node_handler():
           'entity': '',  # Don't reveal failed path for security.
       })
     else:
+      _update_tree_index(new_dir_path)
       return jsonify({
           'result':  'success', 
           'message': 'created the directory',
@@ -741,6 +2935,8 @@ def add_node_handler():
           'entity': '',  # Don't reveal path.
       })
     else:
+      _update_tree_index(new_file_path)
+      _update_search_index(new_file_path)
       return jsonify({
           'result':  'success',
           'message': 'created the file.',
@@ -772,6 +2968,8 @@ def api_move_handler():
       dest_path = base_name + '_' + datetime.datetime.now().strftime(
           '%Y%m%d_%H%M') + extension
     shutil.move(source_path, dest_path)
+    _update_tree_index(source_path, dest_path)
+    _update_search_index(source_path, dest_path)
     return jsonify({
         'result': 'success', 
         'source_path': source_path, 
@@ -783,74 +2981,823 @@ def api_move_handler():
     return _failure_json('smt went wrong')
 
 
-@app.route('/api/search')
-@login_required
-def api_search_handler():
+def _parse_search_request():
+  """Returns the query, regex, literal and error of a search request.
+
+  The mode param is words by default, matching the notes with all the words
+  of the query. regex and substring modes look for the query as a regex or
+  as is, in the files picked through the trigram index. regex is compiled in
+  both, literal is set in substring mode.
+  """
   query = _get_request_param('query')
   if not query:
-    return _failure_json('You need to search for something')
+    return None, None, False, 'You need to search for something'
+  mode = _get_request_param('mode') or 'words'
+  if mode not in ('words', 'regex', 'substring'):
+    return None, None, False, 'Unknown search mode %s' % mode
+  regex = None
+  if mode != 'words':
+    try:
+      regex = re.compile(
+          query if mode == 'regex' else re.escape(query), re.MULTILINE)
+    except re.error as e:
+      return None, None, False, 'Invalid regex: %s' % e
+    if mode == 'regex' and _has_nested_repeat(sre_parse.parse(query)):
+      return None, None, False, (
+          'Repeats in repeats like (a+)+ are not supported, they can take '
+          'forever')
+  return query, regex, mode == 'substring', None
+
+
+def _get_searched_index(root_dir):
+  """Returns the search index to search in, None to run the grep backend.
+
+  The index is used unless --search_backend is another one or SQLite has no
+  FTS5. While the index is built for the first time, the grep backend is used
+  if it runs a grep tool, otherwise this waits for the index.
+  """
+  if args.search_backend != 'index' or not _fts5_available:
+    return None
+  search_index = _get_search_index(root_dir)
+  if search_index.ready.is_set() or _grep_backend.program is None:
+    search_index.ready.wait()
+    return search_index
+  return None
+
+
+def _iter_search(query, regex, literal, root_dir,
+                 limit=_SEARCH_RESULT_LIMIT, search_index=None, prefix=False,
+                 seconds=None):
+  """Yields the search results as they are found.
+
+  Searches the given search index, or runs the grep backend if it is None.
+  Returns the stats and whether the search got to the end of the notes.
+  Searches scanning the files take one of the --search_concurrency slots.
+  Closing the generator stops the search.
+
+  prefix is passed to the index, see _to_fts_query. With seconds set, the
+  search stops after about that long, including the wait for a slot.
+  """
+  start_time = time.time()
+  scanning = True
+  if search_index is None:
+    results = _iter_grep_results(query, root_dir, literal, seconds)
+  elif regex is None:
+    results = search_index.iter_search(query, limit, prefix, seconds)
+    scanning = False
+  else:
+    results = search_index.iter_search_regex(
+        regex, _REGEX_SEARCH_SECONDS if seconds is None else seconds)
+
+  if scanning and not _search_slots.acquire(
+      timeout=_SEARCH_SLOT_WAIT_SECONDS if seconds is None else seconds):
+    return 'too many searches are running, try again later', False
+  count = 0
+  note = None
+  try:
+    while count < limit:
+      try:
+        result = next(results)
+      except StopIteration as stop:
+        note = stop.value
+        break
+      count += 1
+      yield result
+  finally:
+    if hasattr(results, 'close'):
+      results.close()
+    if scanning:
+      _search_slots.release()
+  stats = '%d files matched in %.1f ms' % (
+      count, (time.time() - start_time) * 1000)
+  if count >= limit:
+    stats += ', showing the first %d' % limit
+  return stats + (', ' + note if note else ''), note is None
+
+
+# Most files ranked per search, the pages are sliced from them. Also the
+# upper bound of the limit params.
+_SEARCH_RANKED_LIMIT = 1000
+# Cached results of the grep backends expire after this long, the changes
+# made outside of pervane are not seen without watchdog.
+_SEARCH_CACHE_SECONDS = 60
+# The index searches are cached by the index generation, they only expire to
+# free the space.
+_SEARCH_INDEX_CACHE_SECONDS = 3600
+
+
+def _rank_search_results(results, query, regex, root_dir):
+  """Sorts the search results, the most relevant first.
+
+  Files having the query words in their names, or matching the regex by
+  their names, come first. Then the ones with the better bm25 score or with
+  more matching lines, then the recently modified ones. Ties keep their
+  order.
+  """
+  words = set(re.findall(r'\w+', query.lower())) if regex is None else ()
 
-  root_dir = _get_root_dir()
-  cmd = ''
-  if _is_program_installed('ag'):
-    # ackmate mode for re-using same parsing logic.
-    cmd = ['ag', query, root_dir, '--ackmate', '--stats', '-m', '2']
-    logging.info('Using ag for search')
+  def rank(result):
+    name = os.path.basename(result['file'])
+    if regex is None:
+      name_hits = sum(word in name.lower() for word in words)
+    else:
+      name_hits = 1 if regex.search(name) else 0
+    try:
+      mtime = os.stat(os.path.join(
+          root_dir, result['file'].lstrip(os.sep))).st_mtime
+    except OSError:
+      mtime = 0
+    return name_hits, result.get('score', len(result['matches'])), mtime
+
+  return sorted(results, key=rank, reverse=True)
+
+
+def _iter_ranked_search(query, regex, literal, root_dir, prefix=False,
+                        seconds=None):
+  """Yields the results as they are found, returns them ranked and the stats.
+
+  Up to _SEARCH_RANKED_LIMIT files are ranked, see _rank_search_results.
+  Also returns whether the search got to the end. Such searches are cached by
+  the query, the options and the generation of the searched notes, in the
+  cache backend so that the pages reaching the other workers are served from
+  it too with the filesystem or redis --cache_type. Nothing
+  is yielded for a cached one or for a words search of the index, which
+  finds all at once and without the snippets, see _get_search_page.
+  Closing the generator stops the search.
+
+  prefix and seconds are passed to _iter_search.
+  """
+  search_index = _get_searched_index(root_dir)
+  if search_index is None:
+    generation = (_grep_backend.name, _content_generation.get())
   else:
-    cmd = ['ack', query, root_dir, '--column', '--heading'] 
-    logging.info('Using ack for search')
-  # TODO(hakanu): fallback to find.
-  logging.info('Running cmd: %s', cmd)
-  process = subprocess.Popen(cmd, stdout=subprocess.PIPE)
-  output, error = process.communicate()
-
-  # TODO [basri] what if error occurs?
-
-  # Convert output from binary to string.
-  output = output.decode('utf-8')
-  lines = output.split('\n')
+    generation = ('index', search_index.generation())
+  key = _get_cache_key('search:' + hashlib.sha1(json.dumps(
+      [query, regex and regex.pattern, literal, prefix, generation]).encode(
+          'utf-8')).hexdigest(), root_dir)
+  cached = cache.get(key)
+  if cached:
+    return cached[0], cached[1] + ', cached', True
+
   results = []
-  in_file_results = []
-  fn = ''
-  file_finished = False
-
-  # Extract stats tail first.
-  # ack doesn't have stats, ag has stats in the last 6 lines.
-  tail, delim, prefix = (-6, ';', ':') if cmd[0] == 'ag' else (-1, ':', '')
-
-  stats_str = ' '.join(lines[tail:])
-  in_file_started = False
-  for line in lines[:tail]:
-    if line and line[-1] == '\0':
-      # get rid of NULL terminator
-      line = line[:-1]
-
-    # Check if the line starts with a number or a letter.
-    # Number indicates that it's a file match starting.
-    if line.startswith(prefix + root_dir):
-      fn = line
-      in_file_results = []
-      file_finished = False
-      in_file_started = True
-      continue
-    elif in_file_started and delim in line:
-      in_file_results.append({
-          'snippet': line,
-      })
-      results.append({
-        'file': _get_workspace_path(fn.replace(':', '')),
-        'matches': in_file_results,
-      }) 
+  search = _iter_search(query, regex, literal, root_dir,
+                        _SEARCH_RANKED_LIMIT, search_index, prefix, seconds)
+  try:
+    while True:
+      try:
+        result = next(search)
+      except StopIteration as stop:
+        stats, complete = stop.value
+        break
+      results.append(result)
+      if search_index is None or regex is not None:
+        yield result
+  finally:
+    search.close()
+
+  ranked = _rank_search_results(results, query, regex, root_dir)
+  if complete:
+    cache.set(key, (ranked, stats), timeout=(
+        _SEARCH_INDEX_CACHE_SECONDS if search_index else _SEARCH_CACHE_SECONDS))
+  return ranked, stats, complete
+
+
+def _get_search_page(ranked, offset, limit, query, root_dir, prefix=False):
+  """Returns a page of the ranked results, adding the snippets of the index."""
+  page = ranked[offset:offset + limit]
+  if any(not result['matches'] for result in page):
+    _get_search_index(root_dir).add_snippets(query, page, prefix)
+  return page
+
+
+def _parse_page_request():
+  """Returns the offset and limit params of a paged search and an error."""
+  try:
+    offset = max(int(_get_request_param('offset') or 0), 0)
+    limit = min(int(_get_request_param('limit') or _SEARCH_RESULT_LIMIT),
+                _SEARCH_RANKED_LIMIT)
+  except ValueError:
+    return None, None, 'offset and limit should be numbers'
+  return offset, limit, None
+
+
+@app.route('/api/search')
+@login_required
+def api_search_handler():
+  """Searches the content of the notes, see _parse_search_request.
+
+  Returns a page of the ranked results, starting at the optional offset
+  param and with up to limit files, and the total number of them. Pages of
+  the same search are served from the cache.
+  """
+  query, regex, literal, err = _parse_search_request()
+  if not err:
+    offset, limit, err = _parse_page_request()
+  if err:
+    return _failure_json(err)
 
+  root_dir = _get_root_dir()
+  search = _iter_ranked_search(query, regex, literal, root_dir)
+  while True:
+    try:
+      next(search)
+    except StopIteration as stop:
+      ranked, stats_str, _ = stop.value
+      break
   return jsonify({
       'result': 'success',
       'content': {
-        'results': results,
+        'results': _get_search_page(ranked, offset, limit, query, root_dir),
         'stats': stats_str,
+        'total': len(ranked),
+        'offset': offset,
+        'limit': limit,
       }
   })
 
 
+@app.route('/api/search_stream')
+@login_required
+def api_search_stream_handler():
+  """Streams the search results as newline delimited JSON.
+
+  Takes the params of /api/search. Each line is a result as in /api/search.
+  The first page is sent as soon as its results are found, unranked, other
+  pages and the cached searches are sent ranked once they are known. The
+  last line has the result, the stats, the total number of files and
+  whether the results were ranked. If they weren't, it has the ranked page
+  in results too, to replace the streamed ones with. If the client goes
+  away, the search is stopped, killing ag or ack.
+  """
+  query, regex, literal, err = _parse_search_request()
+  if not err:
+    offset, limit, err = _parse_page_request()
+  if err:
+    return _failure_json(err)
+
+  root_dir = _get_root_dir()
+  search = _iter_ranked_search(query, regex, literal, root_dir)
+
+  def generate():
+    streamed = 0
+    try:
+      while True:
+        try:
+          result = next(search)
+        except StopIteration as stop:
+          ranked, stats, _ = stop.value
+          break
+        if offset == 0 and streamed < limit:
+          streamed += 1
+          yield json.dumps(result) + '\n'
+      page = _get_search_page(ranked, offset, limit, query, root_dir)
+      if not streamed:
+        for result in page:
+          yield json.dumps(result) + '\n'
+      last_line = {
+          'result': 'success',
+          'stats': stats,
+          'total': len(ranked),
+          'ranked': not streamed,
+      }
+      if streamed:
+        last_line['results'] = page
+      yield json.dumps(last_line) + '\n'
+    finally:
+      # Called by the server when the client disconnects too.
+      search.close()
+
+  # The search may need the app context, eg. to build the tree index.
+  response = app.response_class(
+      stream_with_context(generate()), mimetype='application/x-ndjson')
+  response.headers['Cache-Control'] = 'no-cache'
+  # Keeps nginx from buffering the early results.
+  response.headers['X-Accel-Buffering'] = 'no'
+  return response
+
+
+class _SearchGenerations(object):
+  """Latest search generation of each client, to stop the superseded ones.
+
+  Clients number their searches as you type, a search supersedes the ones
+  of the lower generations of the same client. It is per worker process,
+  searches reaching another worker are only stopped by their time limit.
+  """
+
+  def __init__(self, size):
+    self._size = size
+    self._lock = threading.Lock()
+    # Client => (generation, event set when its search is superseded).
+    self._searches = collections.OrderedDict()
+
+  def start(self, client, generation):
+    """Returns the event of the new search, None if it is superseded already.
+
+    The event of the previous search of the client is set.
+    """
+    with self._lock:
+      previous = self._searches.get(client)
+      if previous is not None and previous[0] > generation:
+        return None
+      if previous is not None:
+        previous[1].set()
+      superseded = threading.Event()
+      self._searches[client] = (generation, superseded)
+      self._searches.move_to_end(client)
+      while len(self._searches) > self._size:
+        self._searches.popitem(last=False)
+      return superseded
+
+
+_SEARCH_GENERATIONS_SIZE = 256
+_search_generations = _SearchGenerations(_SEARCH_GENERATIONS_SIZE)
+
+
+@app.route('/api/search_as_you_type')
+@login_required
+def api_search_as_you_type_handler():
+  """Searches while the query is typed, meant to be called on every key.
+
+  Takes the params of /api/search, a client_id and the generation of the
+  search, a number the client increases with every query. The last word
+  of a words query matches the words starting with it. A search stops the
+  running search of a lower generation of the same client, and a search
+  already superseded is not run. Searches stop after
+  --search_as_you_type_ms, then the results found so far are returned with
+  partial set.
+  """
+  query, regex, literal, err = _parse_search_request()
+  if not err:
+    offset, limit, err = _parse_page_request()
+  try:
+    generation = int(_get_request_param('generation') or 0)
+  except ValueError:
+    err = err or 'generation should be a number'
+  if err:
+    return _failure_json(err)
+
+  superseded = _search_generations.start(
+      (current_user.get_id(), _get_request_param('client_id')), generation)
+  if superseded is None:
+    return jsonify({'result': 'superseded', 'generation': generation})
+  root_dir = _get_root_dir()
+  search = _iter_ranked_search(
+      query, regex, literal, root_dir, prefix=True,
+      seconds=args.search_as_you_type_ms / 1000)
+  try:
+    while True:
+      if superseded.is_set():
+        return jsonify({'result': 'superseded', 'generation': generation})
+      try:
+        next(search)
+      except StopIteration as stop:
+        ranked, stats_str, complete = stop.value
+        break
+  finally:
+    search.close()
+  return jsonify({
+      'result': 'success',
+      'generation': generation,
+      'content': {
+        'results': _get_search_page(
+            ranked, offset, limit, query, root_dir, prefix=True),
+        'stats': stats_str,
+        'total': len(ranked),
+        'partial': not complete,
+      }
+  })
+
+
+class _GrepBackend(abc.ABC):
+  """Scans the notes for a query on every search, unlike the index.
+
+  Backends yield (absolute path, line, column, snippet) for the matches of
+  the query, a regex unless literal is set, with the matches of a file next
+  to each other and at most _SEARCH_MATCHES_PER_FILE of them. scan returns a
+  note for the stats, eg. if it is cut by the timeout. seconds overrides
+  the timeout, eg. for the searches as you type.
+  """
+  name = None
+  # Executable to look up on the PATH, None if nothing is run.
+  program = None
+  timeout_seconds = 10
+
+  @classmethod
+  def is_available(cls):
+    return cls.program is None or shutil.which(cls.program) is not None
+
+  @abc.abstractmethod
+  def scan(self, query, root_dir, literal, seconds=None):
+    """Yields the matches of the query, returns a note for the stats."""
+
+
+class _SubprocessGrepBackend(_GrepBackend):
+  """Runs a grep tool and parses its output as it comes."""
+
+  @abc.abstractmethod
+  def command(self, query, root_dir, literal):
+    """Returns the command line of the tool."""
+
+  @abc.abstractmethod
+  def parse(self, lines):
+    """Yields the matches in the output lines of the tool."""
+
+  def scan(self, query, root_dir, literal, seconds=None):
+    if seconds is None:
+      seconds = self.timeout_seconds
+    cmd = self.command(query, root_dir, literal)
+    logging.info('Running cmd: %s', cmd)
+    process = subprocess.Popen(
+        cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    timed_out = threading.Event()
+
+    def kill():
+      timed_out.set()
+      process.kill()
+
+    timer = threading.Timer(seconds, kill)
+    timer.start()
+    try:
+      lines = (line.decode('utf-8', 'replace').rstrip('\n')
+               for line in process.stdout)
+      yield from self.parse(lines)
+    finally:
+      timer.cancel()
+      if process.poll() is None:
+        process.kill()
+      process.stdout.close()
+      process.wait()
+    if timed_out.is_set():
+      return 'stopped after %g seconds' % seconds
+    return None
+
+
+class _RipgrepBackend(_SubprocessGrepBackend):
+  name = 'rg'
+  program = 'rg'
+
+  def command(self, query, root_dir, literal):
+    return (['rg', '--json', '--max-count', str(_SEARCH_MATCHES_PER_FILE)] +
+            (['--fixed-strings'] if literal else []) +
+            ['--', query, root_dir])
+
+  def parse(self, lines):
+    for line in lines:
+      try:
+        message = json.loads(line)
+      except ValueError:
+        continue
+      if message.get('type') != 'match':
+        continue
+      data = message['data']
+      # Non UTF-8 paths and lines come base64 encoded, skipped.
+      path = data['path'].get('text')
+      text = data['lines'].get('text')
+      if path is None or text is None:
+        continue
+      column = 1
+      if data['submatches']:
+        # Offsets are in bytes.
+        column += len(text.encode('utf-8')[
+            :data['submatches'][0]['start']].decode('utf-8', 'replace'))
+      yield path, data['line_number'], column, text.rstrip('\n')
+
+
+class _AgBackend(_SubprocessGrepBackend):
+  name = 'ag'
+  program = 'ag'
+
+  def command(self, query, root_dir, literal):
+    # ackmate mode puts the file names and the match positions on their own.
+    return (['ag', '--ackmate', '-m', str(_SEARCH_MATCHES_PER_FILE)] +
+            (['-Q'] if literal else []) + ['--', query, root_dir])
+
+  def parse(self, lines):
+    path = None
+    for line in lines:
+      # get rid of NULL terminator
+      line = line.rstrip('\0')
+      if line.startswith(':'):
+        path = line[1:]
+      elif path and line:
+        # line;column length[,column length]:text, columns are 0 based.
+        positions, _, text = line.partition(':')
+        line_number, _, columns = positions.partition(';')
+        try:
+          yield (path, int(line_number),
+                 int(columns.split(' ')[0] or 0) + 1, text)
+        except ValueError:
+          continue
+
+
+class _AckBackend(_SubprocessGrepBackend):
+  name = 'ack'
+  program = 'ack'
+  # Perl is slower to start and scan.
+  timeout_seconds = 20
+
+  def command(self, query, root_dir, literal):
+    return (['ack', '--heading', '--column', '--nocolor', '--nopager',
+             '-m', str(_SEARCH_MATCHES_PER_FILE)] +
+            (['-Q'] if literal else []) + ['--', query, root_dir])
+
+  def parse(self, lines):
+    path = None
+    for line in lines:
+      if not line:
+        # A blank line ends the matches of a file.
+        path = None
+      elif path is None:
+        path = line
+      else:
+        # line:column:text
+        parts = line.split(':', 2)
+        try:
+          yield path, int(parts[0]), int(parts[1]), parts[2]
+        except (IndexError, ValueError):
+          continue
+
+
+# Files per task of the grep processes.
+_GREP_SHARD_FILES = 128
+# Files starting with a NUL byte in this many bytes are taken as binary.
+_BINARY_CHECK_BYTES = 8192
+
+
+def _grep_file(regex, path):
+  """Returns (line, column, snippet) of the first few lines matching in path.
+
+  The file is scanned through mmap, with a bytes regex if it is one, so it
+  is not copied into the memory of the process.
+  """
+  try:
+    with open(path, 'rb') as f:
+      if os.fstat(f.fileno()).st_size == 0:
+        return []
+      data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+  except (OSError, ValueError):
+    return []
+  with data:
+    if data.find(b'\0', 0, _BINARY_CHECK_BYTES) != -1:
+      return []
+    if isinstance(regex.pattern, str):
+      # Non ASCII patterns match on the decoded text.
+      data = data[:].decode('utf-8', 'replace')
+      newline = '\n'
+    else:
+      newline = b'\n'
+    matches = []
+    line, line_position, matched_line = 1, 0, 0
+    for match in regex.finditer(data):
+      start = match.start()
+      line += data[line_position:start].count(newline)
+      line_position = start
+      if line == matched_line or start == match.end():
+        continue
+      matched_line = line
+      line_start = data.rfind(newline, 0, start) + 1
+      line_end = data.find(newline, start)
+      if line_end == -1:
+        line_end = len(data)
+      snippet = data[line_start:line_end]
+      prefix = data[line_start:start]
+      if newline == b'\n':
+        snippet = snippet.decode('utf-8', 'replace')
+        prefix = prefix.decode('utf-8', 'replace')
+      matches.append((line, len(prefix) + 1, snippet))
+      if len(matches) >= _SEARCH_MATCHES_PER_FILE:
+        break
+    return matches
+
+
+def _get_regex_matches(regex, content):
+  """Returns the first few lines of content matching the regex.
+
+  Line numbers are counted incrementally from the previous match.
+  """
+  matches = []
+  line, line_position, matched_line = 1, 0, 0
+  for match in regex.finditer(content):
+    if match.start() == match.end():
+      continue
+    line += content.count('\n', line_position, match.start())
+    line_position = match.start()
+    if line == matched_line:
+      continue
+    matched_line = line
+    snippet, snippet_html = _match_to_snippet(
+        content, match.start(), match.end())
+    matches.append({
+        'line': line,
+        'snippet': snippet,
+        'snippet_html': snippet_html,
+    })
+    if len(matches) >= _SEARCH_MATCHES_PER_FILE:
+      break
+  return matches
+
+
+def _grep_index_rows(db_path, pattern, flags, file_ids, deadline):
+  """Greps a shard of the indexed notes, runs in the grep processes.
+
+  Returns (path, matches) of the matching notes in the order of file_ids.
+  The notes left at the deadline are skipped, see _grep_files.
+  """
+  regex = re.compile(pattern, flags)
+  db = sqlite3.connect(db_path, timeout=30)
+  try:
+    results = []
+    for file_id in file_ids:
+      if time.time() > deadline:
+        break
+      row = db.execute('SELECT path, content FROM notes WHERE rowid = ?',
+                       (file_id,)).fetchone()
+      if not row:
+        continue
+      path, content = row
+      matches = _get_regex_matches(regex, content)
+      if matches:
+        results.append((path, matches))
+    return results
+  finally:
+    db.close()
+
+
+def _grep_files(pattern, flags, paths, deadline):
+  """Greps a shard of the files, runs in the grep processes.
+
+  A running call can't be stopped from the searching worker, so the files
+  left at the deadline of the search are skipped. The process is then free
+  after the file it is in.
+  """
+  regex = re.compile(pattern, flags)
+  results = []
+  for path in paths:
+    if time.time() > deadline:
+      break
+    for line, column, snippet in _grep_file(regex, path):
+      results.append((path, line, column, snippet))
+  return results
+
+
+_grep_pool = None
+_grep_pool_lock = threading.Lock()
+
+
+def _get_grep_pool():
+  """Returns the grep processes, started on the first search.
+
+  They are spawned rather than forked, a fork of this threaded process could
+  inherit a lock held by another thread. They import this module with the
+  same args. Not forkserver, it imports the main module without the args.
+  """
+  global _grep_pool
+  with _grep_pool_lock:
+    if _grep_pool is None:
+      _grep_pool = concurrent.futures.ProcessPoolExecutor(
+          max_workers=args.grep_workers or None,
+          mp_context=multiprocessing.get_context('spawn'))
+    return _grep_pool
+
+
+def _is_bytes_safe(pattern):
+  """Whether the regex matches the UTF-8 bytes the same as the decoded text.
+
+  Only the ASCII patterns of literal characters do. ., the sets and the
+  classes like \\w would match a byte of a multibyte character or miss the
+  whole character, the inline flags and \\u escapes differ too.
+  """
+  if not pattern.isascii() or '(?' in pattern:
+    return False
+  escaped = False
+  for char in pattern:
+    if escaped:
+      if char in 'wWbBsSdDuUN':
+        return False
+      escaped = False
+    elif char == '\\':
+      escaped = True
+    elif char in '.[':
+      return False
+  return True
+
+
+class _PythonGrepBackend(_GrepBackend):
+  """Needs nothing installed, greps the files of the tree index.
+
+  The files are split into shards which are scanned in parallel by a pool
+  of --grep_workers processes. Results of a shard are yielded as soon as it
+  is done.
+  """
+  name = 'python'
+
+  def scan(self, query, root_dir, literal, seconds=None):
+    if seconds is None:
+      seconds = self.timeout_seconds
+    pattern = re.escape(query) if literal else query
+    # Bytes patterns can run on the mmap'ed files directly.
+    if _is_bytes_safe(pattern):
+      pattern = pattern.encode('ascii')
+    try:
+      re.compile(pattern, re.MULTILINE)
+    except re.error as e:
+      return 'invalid regex: %s' % e
+
+    deadline = time.time() + seconds
+    root_dir = os.path.abspath(root_dir)
+    paths = [root_dir + workspace_path
+             for workspace_path in _get_tree_index(root_dir).file_paths()]
+    pool = _get_grep_pool()
+    pending = set()
+    try:
+      for i in range(0, len(paths), _GREP_SHARD_FILES):
+        pending.add(pool.submit(
+            _grep_files, pattern, re.MULTILINE,
+            paths[i:i + _GREP_SHARD_FILES], deadline))
+      while pending:
+        done, pending = concurrent.futures.wait(
+            pending, timeout=max(0, deadline - time.time()),
+            return_when=concurrent.futures.FIRST_COMPLETED)
+        if not done:
+          return 'stopped after %g seconds' % seconds
+        for future in done:
+          yield from future.result()
+    finally:
+      # The shards not started yet, eg. the client is gone. Running ones
+      # can't be cancelled, they stop at the deadline.
+      for future in pending:
+        future.cancel()
+    return None
+
+
+# In the order of preference.
+_GREP_BACKENDS = [
+    _RipgrepBackend, _AgBackend, _AckBackend, _PythonGrepBackend]
+
+
+def _detect_grep_backend(name):
+  """Picks the named backend if it is available, otherwise the best one."""
+  backends = {backend.name: backend for backend in _GREP_BACKENDS}
+  if name in backends:
+    if backends[name].is_available():
+      return backends[name]()
+    logging.error('%s is not installed, picking another search backend', name)
+  for backend in _GREP_BACKENDS:
+    if backend.is_available():
+      logging.info('Using %s for the searches without the index', backend.name)
+      return backend()
+
+
+# Detected once, grep tools are not installed while serving.
+_grep_backend = _detect_grep_backend(args.search_backend)
+# Scans running in this process at once, beyond it the searches wait.
+_search_slots = threading.BoundedSemaphore(args.search_concurrency)
+# Searches give up after waiting this long for a slot.
+_SEARCH_SLOT_WAIT_SECONDS = 10
+
+
+def _iter_grep_results(query, root_dir, literal=False, seconds=None):
+  """Runs the grep backend over the root dir, yields the matches of each file.
+
+  Files are yielded as soon as the backend moves on to the next one, the
+  note of the backend is returned. Closing the generator stops the backend,
+  killing the process if there is one. seconds overrides its timeout.
+  """
+  scan = _grep_backend.scan(query, root_dir, literal, seconds)
+  root_dir = root_dir.rstrip(os.sep)
+  file_path = None
+  matches = []
+  try:
+    while True:
+      try:
+        path, line, column, snippet = next(scan)
+      except StopIteration as stop:
+        note = stop.value
+        break
+      path = os.path.normpath(path)
+      if path != file_path:
+        if matches and not is_ignored(file_path):
+          yield {
+              'file': _get_workspace_path(file_path, root_dir),
+              'matches': matches,
+          }
+        file_path = path
+        matches = []
+      matches.append({
+          'line': line,
+          'column': column,
+          'snippet': snippet,
+      })
+    if matches and not is_ignored(file_path):
+      yield {
+          'file': _get_workspace_path(file_path, root_dir),
+          'matches': matches,
+      }
+  finally:
+    scan.close()
+  return note
+
+
 @app.route('/api/glob')
 @login_required
 def api_glob_handler():
@@ -863,14 +3810,24 @@ def api_glob_handler():
   raw_files = os.listdir(glob_root)
   files = []
   dirs = []
+  # File => versioned thumbnail url of the images.
+  thumbnails = {}
   for raw_file in raw_files:
     # Create an actual path to check if it's a directory.
     raw_file = _to_real_path(glob_root, raw_file)
+    if is_ignored(raw_file):
+      continue
     if os.path.isdir(raw_file):
       dirs.append(raw_file.replace(_WORKING_DIR, ''))
       continue
     else:
-      files.append(raw_file.replace(_WORKING_DIR, ''))
+      file = raw_file.replace(_WORKING_DIR, '')
+      files.append(file)
+      if get_mime_type(raw_file) in _THUMBNAIL_MIME_TYPES:
+        # Broken links are listed without one.
+        with contextlib.suppress(FileNotFoundError):
+          thumbnails[file] = _get_media_url(
+              file, _get_file_version(os.stat(raw_file)), prefix='/_thumb')
 
   return jsonify({
       'result': 'success',
@@ -878,6 +3835,7 @@ def api_glob_handler():
         'results': {
           'dirs': dirs,
           'files': files,
+          'thumbnails': thumbnails,
         },
       }
   })
@@ -909,6 +3867,8 @@ def file_upload_handler():
       return _failure_json('No auth')
 
     file.save(dest_path)
+    _update_tree_index(dest_path)
+    _update_search_index(dest_path)
     logging.info('Upload is successful, refreshing the current page '
            'to show new file')
     return jsonify({
@@ -938,7 +3898,238 @@ def static_file_handler(file_path):
   if err:
     return _failure_json(err)
 
-  return send_from_directory(_get_root_dir(), file_path)
+  if args.media_offload != 'none':
+    return _offloaded_media_response(path)
+
+  try:
+    f = open(path, 'rb')
+  except (FileNotFoundError, IsADirectoryError):
+    raise NotFound()
+  # Stat of the opened file, so the version matches the bytes sent.
+  stat = os.fstat(f.fileno())
+  version = _get_file_version(stat)
+  # send_file streams through wsgi.file_wrapper, which is sendfile(2) under
+  # gunicorn, instead of reading the file in the worker.
+  response = send_file(f, mimetype=get_mime_type(path), etag=version,
+                       last_modified=stat.st_mtime, conditional=False)
+  # Not known to werkzeug for file objects.
+  response.content_length = stat.st_size
+  # Conditional answers If-None-Match/If-Modified-Since with a 304 and
+  # a Range header with a 206 of that part, so that videos can be seeked.
+  # Multiple ranges aren't supported, those get the whole file.
+  is_multi_range = request.range is not None and len(request.range.ranges) > 1
+  response.make_conditional(
+      request.environ, accept_ranges=True,
+      complete_length=None if is_multi_range else stat.st_size)
+  response.accept_ranges = 'bytes'
+  return _set_media_cache_control(response, version)
+
+
+def _set_media_cache_control(response, version):
+  if request.args.get('v') == version:
+    # The url changes with the content, see _get_media_url.
+    response.headers['Cache-Control'] = (
+        'public, max-age=%d, immutable' % _MEDIA_MAX_AGE)
+  else:
+    response.headers['Cache-Control'] = 'no-cache'
+  return response
+
+
+def _offloaded_media_response(path):
+  """Leaves sending the file at the authorized path to the web server.
+
+  The response has no body, only the X-Sendfile (Apache mod_xsendfile,
+  lighttpd) or X-Accel-Redirect (nginx) header. The web server then sends
+  the file itself with ranges, so the worker is free right away. For nginx
+  an internal location at --media_offload_prefix aliased to --dir is needed.
+  """
+  try:
+    stat = os.stat(path)
+  except FileNotFoundError:
+    raise NotFound()
+  if not os.path.isfile(path):
+    raise NotFound()
+  version = _get_file_version(stat)
+  response = _not_modified_response(version, stat.st_mtime)
+  if response is None:
+    response = app.response_class(mimetype=get_mime_type(path))
+    _add_validators(response, version, stat.st_mtime)
+    if args.media_offload == 'x_sendfile':
+      # mod_xsendfile unescapes it, headers can't carry any character.
+      response.headers['X-Sendfile'] = urllib.parse.quote(path)
+    else:
+      response.headers['X-Accel-Redirect'] = (
+          args.media_offload_prefix.rstrip('/') + '/' +
+          urllib.parse.quote(os.path.relpath(path, _WORKING_DIR)))
+  return _set_media_cache_control(response, version)
+
+
+# Longest side of the gallery thumbnails in pixels.
+_THUMBNAIL_SIZE = 320
+_THUMBNAIL_QUALITY = 80
+_THUMBNAIL_MIME_TYPES = ('image/jpeg', 'image/png', 'image/gif', 'image/webp',
+                         'image/bmp')
+_THUMBNAIL_FORMAT = (
+    'WEBP' if Image is not None and pil_features.check('webp') else 'JPEG')
+_THUMBNAIL_MIME_TYPE = 'image/' + _THUMBNAIL_FORMAT.lower()
+_thumbnail_pool = None
+_thumbnail_pool_lock = threading.Lock()
+# Cache key => future of the thumbnail being made. Concurrent requests of the
+# same image wait for the same one.
+_thumbnail_jobs = {}
+_thumbnail_jobs_lock = threading.Lock()
+# Bytes in the thumbnail cache dir as of the last listing plus the ones made
+# since then by this process. None until the first listing.
+_thumbnail_cache_bytes = None
+
+
+def _get_thumbnail_pool():
+  """Returns the thumbnail threads, started on the first thumbnail.
+
+  Pillow releases the GIL while decoding and resizing, threads are enough.
+  """
+  global _thumbnail_pool
+  with _thumbnail_pool_lock:
+    if _thumbnail_pool is None:
+      _thumbnail_pool = concurrent.futures.ThreadPoolExecutor(
+          max_workers=args.thumbnail_workers)
+    return _thumbnail_pool
+
+
+def _get_thumbnail_dir():
+  return os.path.join(_PERVANE_CONFIG_DIR, 'thumbnails')
+
+
+def _get_thumbnail_path(path, version):
+  """Path of the thumbnail of the image at the version in the cache.
+
+  The name is a digest of the image version and the thumbnail settings, so a
+  changed image gets a new thumbnail and its old one is evicted eventually.
+  """
+  key = hashlib.sha1(('%s\0%s\0%d\0%s' % (
+      path, version, _THUMBNAIL_SIZE, _THUMBNAIL_FORMAT)).encode(
+          'utf-8', 'surrogateescape')).hexdigest()
+  return os.path.join(
+      _get_thumbnail_dir(), key + '.' + _THUMBNAIL_FORMAT.lower())
+
+
+def _make_thumbnail(path, thumbnail_path):
+  """Writes the thumbnail of the image at path, runs in the thumbnail pool."""
+  if os.path.exists(thumbnail_path):
+    # Made by a job finished after the caller checked.
+    return
+  os.makedirs(_get_thumbnail_dir(), exist_ok=True)
+  with Image.open(path) as image:
+    # JPEGs are decoded at a fraction of their size, much faster for photos.
+    image.draft('RGB', (_THUMBNAIL_SIZE, _THUMBNAIL_SIZE))
+    # Phone photos are stored sideways with an orientation tag.
+    image = ImageOps.exif_transpose(image)
+    image.thumbnail((_THUMBNAIL_SIZE, _THUMBNAIL_SIZE))
+    if _THUMBNAIL_FORMAT == 'JPEG' and image.mode not in ('RGB', 'L'):
+      image = image.convert('RGB')
+    with AtomicFile(thumbnail_path, 'wb') as f:
+      image.save(f, _THUMBNAIL_FORMAT, quality=_THUMBNAIL_QUALITY)
+  _add_thumbnail_bytes(os.path.getsize(thumbnail_path))
+
+
+def _get_thumbnail(path, version):
+  """Returns the cached thumbnail of the image, makes it if needed.
+
+  None is returned if it can't be made, eg. the image is broken.
+  """
+  thumbnail_path = _get_thumbnail_path(path, version)
+  try:
+    # Recently used ones are evicted last.
+    os.utime(thumbnail_path)
+    return thumbnail_path
+  except FileNotFoundError:
+    pass
+
+  with _thumbnail_jobs_lock:
+    future = _thumbnail_jobs.get(thumbnail_path)
+    if future is None:
+      future = _get_thumbnail_pool().submit(
+          _make_thumbnail, path, thumbnail_path)
+      _thumbnail_jobs[thumbnail_path] = future
+      future.add_done_callback(
+          lambda _: _thumbnail_jobs.pop(thumbnail_path, None))
+  try:
+    future.result()
+  except Exception:
+    logging.error('Making the thumbnail of %r failed', path, exc_info=True)
+    return None
+  return thumbnail_path
+
+
+def _add_thumbnail_bytes(size):
+  global _thumbnail_cache_bytes
+  with _thumbnail_jobs_lock:
+    if _thumbnail_cache_bytes is not None:
+      _thumbnail_cache_bytes += size
+      if _thumbnail_cache_bytes <= args.thumbnail_cache_bytes:
+        return
+  _evict_thumbnails()
+
+
+def _evict_thumbnails():
+  """Deletes the least recently used thumbnails beyond the budget.
+
+  Goes down to 3/4 of --thumbnail_cache_bytes so that it doesn't run again
+  for every new thumbnail. The dir is listed, so the thumbnails made by the
+  other processes are counted too.
+  """
+  global _thumbnail_cache_bytes
+  thumbnails = []
+  with os.scandir(_get_thumbnail_dir()) as entries:
+    for entry in entries:
+      # Dot files are the ones being written.
+      if entry.name.startswith('.'):
+        continue
+      try:
+        stat = entry.stat()
+      except FileNotFoundError:
+        # Evicted by another process.
+        continue
+      thumbnails.append((stat.st_mtime, stat.st_size, entry.path))
+  total_bytes = sum(size for _, size, _ in thumbnails)
+  if total_bytes > args.thumbnail_cache_bytes:
+    thumbnails.sort()
+    for _, size, thumbnail_path in thumbnails:
+      if total_bytes <= args.thumbnail_cache_bytes * 3 // 4:
+        break
+      with contextlib.suppress(FileNotFoundError):
+        os.remove(thumbnail_path)
+      total_bytes -= size
+  with _thumbnail_jobs_lock:
+    _thumbnail_cache_bytes = total_bytes
+
+
+@app.route('/_thumb/<path:file_path>', methods=['GET'])
+@login_required
+def thumbnail_handler(file_path):
+  """Small version of the image at the workspace path for the gallery.
+
+  Made on the first request and kept under --config_dir. Redirects to the
+  image itself when Pillow isn't installed or the image can't be read.
+  """
+  path, err = _get_real_path(file_path)
+  if err:
+    return _failure_json(err)
+  try:
+    stat = os.stat(path)
+  except FileNotFoundError:
+    raise NotFound()
+  version = _get_file_version(stat)
+
+  thumbnail_path = None
+  if Image is not None and get_mime_type(path) in _THUMBNAIL_MIME_TYPES:
+    thumbnail_path = _get_thumbnail(path, version)
+  if thumbnail_path is None:
+    return redirect(_get_media_url(file_path, version))
+  response = send_file(
+      thumbnail_path, mimetype=_THUMBNAIL_MIME_TYPE, conditional=True,
+      etag=os.path.splitext(os.path.basename(thumbnail_path))[0])
+  return _set_media_cache_control(response, version)
 
 
 # TODO(hakanu): Slowly get rid of this in favor of production gunicorn.
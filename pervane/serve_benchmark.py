@@ -0,0 +1,83 @@
+"""Benchmarks the file tree scan on a simulated high latency filesystem.
+
+Every os.scandir call sleeps for the given latency, like a round trip to an
+NFS/SMB server, and the tree of a generated note dir is built sequentially and
+with the --scan_workers thread pool.
+
+# Run:
+python3 serve_benchmark.py --dirs=400 --files_per_dir=20 --latency_ms=5
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+parser = argparse.ArgumentParser(description='Benchmark the tree scan.')
+parser.add_argument('--dirs', dest='dirs', type=int, default=400,
+                    help='Number of generated dirs.')
+parser.add_argument('--files_per_dir', dest='files_per_dir', type=int,
+                    default=20, help='Number of notes in each dir.')
+parser.add_argument('--fanout', dest='fanout', type=int, default=8,
+                    help='Number of child dirs of each dir.')
+parser.add_argument('--latency_ms', dest='latency_ms', type=float, default=5,
+                    help='Simulated latency of each dir listing.')
+parser.add_argument('--workers', dest='workers', type=int, nargs='*',
+                    default=[1, 4, 8, 16],
+                    help='--scan_workers values to compare.')
+benchmark_args = parser.parse_args()
+
+
+def _generate_notes(root_dir):
+  dirs = [root_dir]
+  for i in range(benchmark_args.dirs):
+    # Breadth first, every dir gets fanout children.
+    dir_path = os.path.join(dirs[i // benchmark_args.fanout], 'dir%d' % i)
+    os.mkdir(dir_path)
+    dirs.append(dir_path)
+  for dir_path in dirs:
+    for j in range(benchmark_args.files_per_dir):
+      open(os.path.join(dir_path, 'note%d.md' % j), 'w').close()
+
+
+def _slow_scandir(scandir, latency_seconds):
+  def scandir_with_latency(path):
+    time.sleep(latency_seconds)
+    return scandir(path)
+  return scandir_with_latency
+
+
+def main():
+  root_dir = tempfile.mkdtemp()
+  config_dir = tempfile.mkdtemp()
+  try:
+    _generate_notes(root_dir)
+    # serve parses the command line when it is imported.
+    sys.argv = [sys.argv[0], '--dir', root_dir, '--config_dir', config_dir]
+    import serve
+
+    os.scandir = _slow_scandir(os.scandir, benchmark_args.latency_ms / 1000)
+    print('%d dirs, %d notes, %.1f ms latency per listing' % (
+        benchmark_args.dirs + 1,
+        (benchmark_args.dirs + 1) * benchmark_args.files_per_dir,
+        benchmark_args.latency_ms))
+
+    baseline = None
+    expected_tree = None
+    for workers in benchmark_args.workers:
+      start = time.time()
+      tree = serve._make_tree(root_dir + os.sep, root_dir, workers)
+      elapsed = time.time() - start
+      if expected_tree is None:
+        baseline, expected_tree = elapsed, tree
+      assert tree == expected_tree, 'Trees differ with %d workers' % workers
+      print('scan_workers=%-3d %8.3f s  %5.1fx' % (
+          workers, elapsed, baseline / elapsed))
+  finally:
+    shutil.rmtree(root_dir)
+    shutil.rmtree(config_dir)
+
+
+if __name__ == '__main__':
+  main()
@@ -1,4 +1,14 @@
+import contextlib
+import json
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 import unittest
+from unittest import mock
 import serve
 import argparse
 
@@ -71,5 +81,890 @@ class ServeTest(unittest.TestCase):
         with self.assertRaises(TypeError):
             serve._is_filename_allowed(False)
 
+    def test_tree_index(self):
+        with tempfile.TemporaryDirectory() as root_dir:
+            os.mkdir(os.path.join(root_dir, 'b'))
+            open(os.path.join(root_dir, 'a.md'), 'w').close()
+            tree_index = serve._TreeIndex(root_dir)
+            self.assertEqual('', tree_index.tree['name'])
+            self.assertEqual(
+                ['/b', '/a.md'],
+                [child['path'] for child in tree_index.tree['children']])
+            b_node = tree_index.tree['children'][0]
+            self.assertEqual(
+                os.path.getmtime(os.path.join(root_dir, 'b')),
+                b_node['mtime'])
+            # Files aren't stat'ed.
+            self.assertNotIn('mtime', tree_index.tree['children'][1])
+
+            os.makedirs(os.path.join(root_dir, 'b', 'c'))
+            open(os.path.join(root_dir, 'b', 'c', 'd.md'), 'w').close()
+            generation = tree_index.generation
+            tree_index.refresh_dir(os.path.join(root_dir, 'b'))
+            self.assertGreater(tree_index.generation, generation)
+            c_node = tree_index.tree['children'][0]['children'][0]
+            self.assertEqual('/b/c', c_node['path'])
+            self.assertEqual('/b/c/d.md', c_node['children'][0]['path'])
+            self.assertEqual(2, tree_index.file_names.size)
+
+            os.remove(os.path.join(root_dir, 'a.md'))
+            tree_index.resync()
+            self.assertEqual(
+                ['/b'],
+                [child['path'] for child in tree_index.tree['children']])
+            self.assertIn('"/b/c/d.md"', tree_index.response_json())
+            self.assertEqual(
+                ['/b/c/d.md'],
+                [path for _, path, _ in tree_index.file_names.find('md')])
+
+    def test_tree_index_subtree(self):
+        with tempfile.TemporaryDirectory() as root_dir:
+            os.makedirs(os.path.join(root_dir, 'a', 'b', 'c'))
+            open(os.path.join(root_dir, 'a', 'b', 'd.md'), 'w').close()
+            tree_index = serve._TreeIndex(root_dir)
+            self.assertIs(tree_index.tree, tree_index.subtree('/'))
+            self.assertIsNone(tree_index.subtree('/x', 1))
+
+            a_node = tree_index.subtree('/a', 1)
+            self.assertEqual(1, a_node['child_count'])
+            b_node = a_node['children'][0]
+            self.assertEqual('/a/b', b_node['path'])
+            self.assertEqual(2, b_node['child_count'])
+            self.assertEqual([], b_node['children'])
+            # Slicing doesn't touch the index.
+            self.assertEqual(
+                2, len(tree_index.subtree('/a/b')['children']))
+
+    def test_ignore_matcher(self):
+        with tempfile.TemporaryDirectory() as root_dir:
+            matcher = serve._IgnoreMatcher(['.git', '.*.swp'], root_dir, 0)
+            self.assertTrue(matcher.is_ignored(root_dir + '/.git/HEAD'))
+            self.assertTrue(matcher.is_ignored(root_dir + '/a/b.md.swp'))
+            self.assertFalse(matcher.is_ignored(root_dir + '/a/b.md'))
+
+            os.makedirs(os.path.join(root_dir, 'a', 'vendor'))
+            with open(os.path.join(root_dir, 'a', '.pervaneignore'), 'w') as f:
+                f.write('# comment\nvendor/\n/build\n*.log\n')
+            self.assertTrue(matcher.is_ignored(root_dir + '/a/vendor'))
+            self.assertTrue(matcher.is_ignored(root_dir + '/a/x/vendor/y.md'))
+            self.assertTrue(matcher.is_ignored(root_dir + '/a/build/y.md'))
+            self.assertFalse(matcher.is_ignored(root_dir + '/a/x/build/y.md'))
+            self.assertTrue(matcher.is_ignored(root_dir + '/a/x/y.log'))
+            self.assertFalse(matcher.is_ignored(root_dir + '/b/vendor'))
+            self.assertFalse(matcher.is_ignored(root_dir + '/a/vendors'))
+
+    def test_make_tree_parallel(self):
+        with tempfile.TemporaryDirectory() as root_dir:
+            for i in range(5):
+                os.makedirs(os.path.join(root_dir, 'd%d' % i, 'e'))
+                open(os.path.join(root_dir, 'd%d' % i, 'e', 'f.md'),
+                     'w').close()
+            self.assertEqual(
+                serve._make_tree(root_dir + os.sep, root_dir, 1),
+                serve._make_tree(root_dir + os.sep, root_dir, 4))
+
+    def test_shared_generation(self):
+        with tempfile.TemporaryDirectory() as config_dir:
+            path = os.path.join(config_dir, 'generation')
+            generation = serve._SharedGeneration(path)
+            other_worker_generation = serve._SharedGeneration(path)
+            self.assertEqual(0, generation.get())
+            self.assertEqual(1, other_worker_generation.bump())
+            self.assertEqual(1, generation.get())
+
+    def test_tree_event_handler_ignores_reads(self):
+        tree_index = mock.Mock(root_dir='/n')
+        handler = serve._TreeEventHandler(tree_index)
+        with mock.patch.object(serve, '_update_search_index') as update:
+            for event_type in ('opened', 'closed_no_write'):
+                handler.on_any_event(mock.Mock(
+                    event_type=event_type, src_path='/n/a.md',
+                    is_directory=False))
+            update.assert_not_called()
+            tree_index.refresh_dir.assert_not_called()
+
+            handler.on_any_event(mock.Mock(
+                event_type='created', src_path='/n/a.md', dest_path='',
+                is_directory=False))
+            update.assert_called_once_with('/n/a.md', '', root_dir='/n')
+            tree_index.refresh_dir.assert_called_once_with('/n')
+
+    def test_sync_tree_index_across_workers(self):
+        with tempfile.TemporaryDirectory() as root_dir:
+            cache = serve.Cache(
+                serve.Flask(__name__), config={'CACHE_TYPE': 'SimpleCache'})
+            # Stand-in of the redis backend, same interface.
+            generation = serve._CacheGeneration(cache, 'tree_generation')
+            with mock.patch.object(serve, 'cache', cache), \
+                    mock.patch.object(serve, '_tree_generation', generation):
+                worker1 = serve._TreeIndex(root_dir)
+                worker2 = serve._TreeIndex(root_dir)
+                serve._publish_tree_snapshot(worker1, generation.get())
+                serve._sync_tree_index(worker2)
+
+                open(os.path.join(root_dir, 'a.md'), 'w').close()
+                worker1.refresh_dir(root_dir)
+                serve._publish_tree_snapshot(worker1, generation.bump())
+                self.assertEqual([], worker2.tree['children'])
+                serve._sync_tree_index(worker2)
+                self.assertEqual(
+                    ['/a.md'],
+                    [child['path'] for child in worker2.tree['children']])
+                self.assertEqual(['/a.md'], worker2.file_paths())
+
+    def test_tree_index_eviction(self):
+        with tempfile.TemporaryDirectory() as users_dir:
+            for user in ('u1', 'u2', 'u3'):
+                os.makedirs(os.path.join(users_dir, user, 'notes'))
+            with mock.patch.object(serve, '_tree_indexes',
+                                   serve.collections.OrderedDict()), \
+                    mock.patch.object(serve.args, 'index_cache_bytes', 1), \
+                    serve.app.test_request_context():
+                u1 = serve._get_tree_index(os.path.join(users_dir, 'u1'))
+                u2 = serve._get_tree_index(os.path.join(users_dir, 'u2'))
+                self.assertIsNot(u1, u2)
+                # Budget only fits the most recently used one.
+                self.assertEqual(
+                    [u2.root_dir], list(serve._tree_indexes.keys()))
+
+                serve.args.index_cache_bytes = 10 * 1024 * 1024
+                serve._get_tree_index(os.path.join(users_dir, 'u3'))
+                self.assertIs(
+                    u2, serve._get_tree_index(os.path.join(users_dir, 'u2')))
+                self.assertEqual(
+                    [os.path.join(users_dir, 'u3'), u2.root_dir],
+                    list(serve._tree_indexes.keys()))
+
+    def test_file_paths_changes(self):
+        with tempfile.TemporaryDirectory() as root_dir:
+            open(os.path.join(root_dir, 'a.md'), 'w').close()
+            tree_index = serve._TreeIndex(root_dir)
+            version1, file_paths = tree_index.file_paths_version()
+            self.assertEqual(['/a.md'], file_paths)
+            self.assertEqual(([], []),
+                             tree_index.file_paths_changes(version1))
+            self.assertIsNone(tree_index.file_paths_changes('unknown'))
+
+            open(os.path.join(root_dir, 'b.md'), 'w').close()
+            tree_index.refresh_dir(root_dir)
+            version2, _ = tree_index.file_paths_version()
+            os.remove(os.path.join(root_dir, 'a.md'))
+            tree_index.refresh_dir(root_dir)
+            self.assertEqual((['/b.md'], ['/a.md']),
+                             tree_index.file_paths_changes(version1))
+            self.assertEqual(([], ['/a.md']),
+                             tree_index.file_paths_changes(version2))
+            # Same files, same version in every worker.
+            self.assertEqual(
+                tree_index.file_paths_version()[0],
+                serve._TreeIndex(root_dir).file_paths_version()[0])
+
+    def test_cacheable_response(self):
+        body = 'x' * 2000
+        with serve.app.test_request_context():
+            response = serve._cacheable_response(body, 'v1', last_modified=10)
+            self.assertEqual(200, response.status_code)
+            self.assertEqual('"v1"', response.headers['ETag'])
+        with serve.app.test_request_context(
+                headers={'If-None-Match': '"v1"'}):
+            self.assertEqual(
+                304, serve._cacheable_response(body, 'v1').status_code)
+            self.assertEqual(
+                200, serve._cacheable_response(body, 'v2').status_code)
+        with serve.app.test_request_context(
+                headers={'Accept-Encoding': 'gzip',
+                         'If-None-Match': '"v1.gz"'}):
+            self.assertEqual(
+                304, serve._cacheable_response(body, 'v1').status_code)
+        with serve.app.test_request_context(
+                headers={'Accept-Encoding': 'gzip'}):
+            response = serve._cacheable_response(body, 'v1')
+            self.assertEqual('gzip', response.headers['Content-Encoding'])
+            self.assertEqual('"v1.gz"', response.headers['ETag'])
+
+    def test_get_media_url(self):
+        self.assertEqual('/_img/a/b%20c.png?v=1-2-3',
+                         serve._get_media_url('a/b c.png', '1-2-3'))
+        self.assertEqual('/_img/a/%23.mp4?v=1-2-3',
+                         serve._get_media_url('/a/#.mp4', '1-2-3'))
+
+    def test_offloaded_media_response(self):
+        with tempfile.TemporaryDirectory() as root_dir:
+            path = os.path.join(root_dir, 'a b.mp4')
+            with open(path, 'wb') as f:
+                f.write(b'video')
+            version = serve._get_file_version(os.stat(path))
+            with mock.patch.object(serve, '_WORKING_DIR', root_dir), \
+                    mock.patch.object(serve.args, 'media_offload',
+                                      'x_accel_redirect'), \
+                    serve.app.test_request_context('/?v=' + version):
+                response = serve._offloaded_media_response(path)
+                self.assertEqual(200, response.status_code)
+                self.assertEqual(b'', response.get_data())
+                self.assertEqual('video/mp4', response.mimetype)
+                self.assertEqual('/_pervane_media/a%20b.mp4',
+                                 response.headers['X-Accel-Redirect'])
+                self.assertIn('immutable', response.headers['Cache-Control'])
+            with mock.patch.object(serve.args, 'media_offload', 'x_sendfile'), \
+                    serve.app.test_request_context(
+                        headers={'If-None-Match': '"%s"' % version}):
+                response = serve._offloaded_media_response(path)
+                self.assertEqual(304, response.status_code)
+                self.assertNotIn('X-Sendfile', response.headers)
+                self.assertEqual('no-cache', response.headers['Cache-Control'])
+
+    def test_static_file_ranges(self):
+        with tempfile.TemporaryDirectory() as root_dir:
+            with open(os.path.join(root_dir, 'a.mp4'), 'wb') as f:
+                f.write(b'0123456789')
+            client = self._client(root_dir)
+
+            response = client.get('/_img/a.mp4')
+            self.assertEqual(200, response.status_code)
+            self.assertEqual('bytes', response.headers['Accept-Ranges'])
+            self.assertEqual(b'0123456789', response.get_data())
+
+            response = client.get(
+                '/_img/a.mp4', headers={'Range': 'bytes=2-5'})
+            self.assertEqual(206, response.status_code)
+            self.assertEqual('bytes 2-5/10', response.headers['Content-Range'])
+            self.assertEqual('bytes', response.headers['Accept-Ranges'])
+            self.assertEqual(b'2345', response.get_data())
+
+            response = client.get(
+                '/_img/a.mp4', headers={'Range': 'bytes=20-30'})
+            self.assertEqual(416, response.status_code)
+            self.assertEqual('bytes */10', response.headers['Content-Range'])
+
+            # Multiple ranges get the whole file.
+            response = client.get(
+                '/_img/a.mp4', headers={'Range': 'bytes=0-1,4-5'})
+            self.assertEqual(200, response.status_code)
+            self.assertNotIn('Content-Range', response.headers)
+            self.assertEqual(b'0123456789', response.get_data())
+
+            with mock.patch.object(serve.args, 'media_offload', 'x_sendfile'):
+                response = client.get(
+                    '/_img/a.mp4', headers={'Range': 'bytes=2-5'})
+                self.assertEqual(200, response.status_code)
+                self.assertEqual(os.path.join(root_dir, 'a.mp4'),
+                                 response.headers['X-Sendfile'])
+                self.assertEqual(b'', response.get_data())
+            with mock.patch.object(serve.args, 'media_offload',
+                                   'x_accel_redirect'):
+                response = client.get('/_img/a.mp4')
+                self.assertEqual('/_pervane_media/a.mp4',
+                                 response.headers['X-Accel-Redirect'])
+                self.assertNotIn('X-Sendfile', response.headers)
+
+    @unittest.skipIf(serve.Image is None, 'Pillow is not installed')
+    def test_thumbnails(self):
+        with tempfile.TemporaryDirectory() as root_dir, \
+                tempfile.TemporaryDirectory() as config_dir, \
+                mock.patch.object(serve, '_PERVANE_CONFIG_DIR', config_dir), \
+                mock.patch.object(serve, '_thumbnail_cache_bytes', None):
+            paths = []
+            for i in range(3):
+                path = os.path.join(root_dir, '%d.png' % i)
+                serve.Image.new('RGB', (1000, 500), (i, 0, 0)).save(path)
+                paths.append(path)
+            thumbnail_paths = []
+            for path in paths:
+                version = serve._get_file_version(os.stat(path))
+                thumbnail_path = serve._get_thumbnail(path, version)
+                with serve.Image.open(thumbnail_path) as image:
+                    self.assertEqual((320, 160), image.size)
+                self.assertEqual(
+                    thumbnail_path, serve._get_thumbnail(path, version))
+                thumbnail_paths.append(thumbnail_path)
+            os.utime(thumbnail_paths[0], (0, 0))
+
+            size = os.path.getsize(thumbnail_paths[1])
+            with mock.patch.object(serve.args, 'thumbnail_cache_bytes',
+                                   size * 2):
+                serve._evict_thumbnails()
+            # Least recently used one is gone.
+            self.assertFalse(os.path.exists(thumbnail_paths[0]))
+            self.assertTrue(os.path.exists(thumbnail_paths[2]))
+
+            with open(paths[0], 'w') as f:
+                f.write('broken')
+            self.assertIsNone(serve._get_thumbnail(
+                paths[0], serve._get_file_version(os.stat(paths[0]))))
+
+    def test_get_path_version(self):
+        with tempfile.TemporaryDirectory() as root_dir:
+            path = os.path.join(root_dir, 'a.md')
+            self.assertIsNone(serve._get_path_version(path))
+            with serve._locked_for_write():
+                with serve.AtomicFile(path, 'w') as f:
+                    f.write('same')
+            version = serve._get_path_version(path)
+            self.assertEqual(version, serve._get_path_version(path))
+            with serve.AtomicFile(path, 'w') as f:
+                f.write('same')
+            # A rewrite is a new version even with the same size and mtime.
+            self.assertNotEqual(version, serve._get_path_version(path))
+
+    def test_content_cache(self):
+        size = sys.getsizeof('a' * 100)
+        cache = serve._ContentCache(size * 16 * 2)
+        self.assertIsNone(cache.get('/a', 'v1'))
+        cache.put('/a', 'v1', 'a' * 100)
+        self.assertEqual('a' * 100, cache.get('/a', 'v1'))
+        self.assertIsNone(cache.get('/a', 'v2'))
+        cache.put('/b', 'v1', 'b' * 100)
+        cache.get('/a', 'v1')
+        # Too large for the budget.
+        cache.put('/c', 'v1', 'c' * 1000)
+        self.assertIsNone(cache.get('/c', 'v1'))
+        cache.put('/a', 'v2', 'a' * 200)
+        self.assertEqual(
+            {'hits': 2, 'misses': 3, 'entries': 2,
+             'bytes': size + sys.getsizeof('a' * 200), 'max_bytes': size * 32},
+            cache.stats())
+        cache.remove('/a')
+        self.assertEqual(size, cache.stats()['bytes'])
+
+    def test_read_content_window(self):
+        with tempfile.TemporaryDirectory() as root_dir, \
+                mock.patch.object(serve, '_LINE_INDEX_BLOCK', 8):
+            path = os.path.join(root_dir, 'a.log')
+            with open(path, 'w') as f:
+                f.write(''.join('line %d\n' % i for i in range(20)) + 'end')
+            window = serve._read_content_window(path, line=9, lines=2)
+            self.assertEqual('line 9\nline 10\n', window['content'])
+            self.assertEqual(2, window['line_count'])
+            self.assertEqual(21, window['total_lines'])
+            self.assertEqual(
+                'end', serve._read_content_window(path, line=20)['content'])
+            self.assertEqual(
+                '', serve._read_content_window(path, line=30)['content'])
+            window = serve._read_content_window(path, offset=7, length=6)
+            self.assertEqual('line 1', window['content'])
+            self.assertEqual(13, window['end_offset'])
+
+            with open(path, 'w') as f:
+                f.write('x' * 10 + '\nlast line')
+            with mock.patch.object(serve, '_WINDOW_MAX_BYTES', 4):
+                window = serve._read_content_window(path, line=0)
+                self.assertEqual(('xxxx', 0, True), (
+                    window['content'], window['line_count'],
+                    window['truncated']))
+                contents = [window['content']]
+                while window['end_offset'] < window['size']:
+                    window = serve._read_content_window(
+                        path, line=window['line'] + window['line_count'],
+                        offset=(window['end_offset']
+                                if window['truncated'] else 0))
+                    contents.append(window['content'])
+                self.assertEqual('x' * 10 + '\nlast line', ''.join(contents))
+                self.assertEqual((1, 1, False), (
+                    window['line'], window['line_count'],
+                    window['truncated']))
+
+            open(path, 'w').close()
+            window = serve._read_content_window(path, line=0)
+            self.assertEqual(('', 0), (window['content'], window['total_lines']))
+
+    def test_apply_patch(self):
+        edit = lambda start, end, text: {
+            'start': start, 'end': end, 'text': text}
+        self.assertEqual('a-b-c', serve._apply_patch(
+            'abc', [edit(1, 1, '-'), edit(2, 2, '-')]))
+        self.assertEqual('xbc', serve._apply_patch('abc', [edit(0, 1, 'x')], 3))
+        # Offsets are in UTF-16 code units, the emoji is 2 of them.
+        self.assertEqual('\U0001F600!', serve._apply_patch(
+            '\U0001F600?', [edit(2, 3, '!')], 3))
+        self.assertIsNone(serve._apply_patch(
+            '\U0001F600?', [edit(1, 2, '')]))
+        self.assertIsNone(serve._apply_patch('abc', [edit(0, 1, 'x')], 4))
+        self.assertIsNone(serve._apply_patch('abc', [edit(2, 4, 'x')]))
+        self.assertIsNone(serve._apply_patch(
+            'abc', [edit(2, 2, 'x'), edit(1, 1, 'y')]))
+        self.assertIsNone(serve._apply_patch('abc', [{'start': 0}]))
+
+    def test_update_base_version(self):
+        with tempfile.TemporaryDirectory() as root_dir:
+            path = os.path.join(root_dir, 'a.md')
+            with open(path, 'w') as f:
+                f.write('old')
+            client = self._client(root_dir)
+
+            response = client.post('/api/update', json={
+                'file_path': '/a.md', 'updated_content': 'new',
+                'base_version': None})
+            self.assertEqual('success', response.json['result'])
+            with open(path) as f:
+                self.assertEqual('new', f.read())
+            response = client.post('/api/update', json={
+                'file_path': '/a.md', 'updated_content': 'newer',
+                'base_version': 5})
+            self.assertEqual('base_version should be a string',
+                             response.json['result'])
+
+            version = serve._get_file_version(os.stat(path))
+            response = client.post('/api/update', json={
+                'file_path': '/a.md', 'updated_content': 'newer',
+                'base_version': 'x' + version})
+            self.assertEqual(409, response.status_code)
+            self.assertEqual(version, response.json['version'])
+
+    def test_write_coalescer(self):
+        coalescer = serve._WriteCoalescer(2)
+        self.assertFalse(coalescer.is_stale('/a', 'c1', 2))
+        self.assertTrue(coalescer.is_stale('/a', 'c1', 1))
+        self.assertTrue(coalescer.is_stale('/a', 'c1', 2))
+        self.assertFalse(coalescer.is_stale('/a', 'c2', 1))
+        self.assertFalse(coalescer.is_stale('/a', '', 1))
+
+        self.assertFalse(coalescer.is_unchanged('/a', 'd1', 'v1'))
+        coalescer.written('/a', 'd1', 'v1')
+        self.assertTrue(coalescer.is_unchanged('/a', 'd1', 'v1'))
+        self.assertFalse(coalescer.is_unchanged('/a', 'd2', 'v1'))
+        # Changed by something else since then.
+        self.assertFalse(coalescer.is_unchanged('/a', 'd1', 'v2'))
+
+        coalescer.written('/b', 'd1', 'v1')
+        coalescer.written('/c', 'd1', 'v1')
+        self.assertFalse(coalescer.is_unchanged('/a', 'd1', 'v1'))
+        self.assertFalse(coalescer.is_stale('/a', 'c1', 1))
+
+    def test_fuzzy_score(self):
+        def score(query, target):
+            result = serve._fuzzy_score(
+                query, target, target.lower(), serve._next_beginnings(target))
+            return result and result[0]
+
+        # Examples of fuzzysort.
+        self.assertEqual(-16, score('fs', 'Fuzzy Search'))
+        self.assertEqual(0, score('test', 'test'))
+        self.assertIsNone(score('doesnt exist', 'target'))
+        self.assertEqual(-18, score('mr', 'MeshRenderer.cpp'))
+        self.assertEqual(-6009, score('mr', 'Monitor.cpp'))
+
+    def test_file_name_index(self):
+        file_names = serve._FileNameIndex()
+        for path in ('/notes/todo.md', '/notes/work/meeting.md',
+                     '/notes/work/todo.txt', '/readme.md'):
+            file_names.add(path)
+        self.assertEqual(4, file_names.size)
+        self.assertEqual(
+            ['/notes/todo.md', '/notes/work/todo.txt'],
+            [path for _, path, _ in file_names.find('todo')])
+        score, path, indexes = file_names.find('NWM')[0]
+        self.assertEqual('/notes/work/meeting.md', path)
+        self.assertEqual([1, 7, 12], indexes)
+        self.assertEqual([], file_names.find('xyz'))
+        self.assertEqual(1, len(file_names.find('md', limit=1)))
+
+        file_names.remove_file('/notes/todo.md')
+        file_names.remove_dir('/notes/work')
+        self.assertEqual(1, file_names.size)
+        self.assertEqual([], file_names.find('todo'))
+        self.assertEqual('/readme.md', file_names.find('rm')[0][1])
+
+    def test_search_index(self):
+        with tempfile.TemporaryDirectory() as root_dir:
+            with open(os.path.join(root_dir, 'a.md'), 'w') as f:
+                f.write('zebra and <lion>')
+            with open(os.path.join(root_dir, 'b.md'), 'w') as f:
+                f.write('zebra zebra zebra')
+            open(os.path.join(root_dir, 'c.png'), 'w').close()
+            search_index = serve._SearchIndex(
+                root_dir, os.path.join(root_dir, 'index.sqlite'))
+            self.assertFalse(search_index.ready.is_set())
+            search_index.sync(['/a.md', '/b.md', '/c.png'])
+            self.assertTrue(search_index.ready.is_set())
+
+            results = search_index.search('zebra')
+            self.assertEqual(['/b.md', '/a.md'],
+                             [result['file'] for result in results])
+            self.assertEqual(
+                '<mark>zebra</mark> and &lt;lion&gt;',
+                results[1]['matches'][0]['snippet_html'])
+            # Operators and quotes are searched literally.
+            self.assertEqual([], search_index.search('zebra OR "lion'))
+            self.assertEqual(1, len(search_index.search('lion AND')))
+            self.assertEqual([], search_index.search('zeb'))
+            results = search_index.search('zeb', prefix=True, snippets=False)
+            self.assertEqual(['/b.md', '/a.md'],
+                             [result['file'] for result in results])
+            self.assertEqual([], results[0]['matches'])
+            search_index.add_snippets('zeb', results, prefix=True)
+            self.assertEqual('<mark>zebra</mark> and &lt;lion&gt;',
+                             results[1]['matches'][0]['snippet_html'])
+
+            generation = search_index.generation()
+            search_index.sync(['/a.md', '/b.md', '/c.png'])
+            self.assertEqual(generation, search_index.generation())
+
+            os.mkdir(os.path.join(root_dir, 'd'))
+            os.rename(os.path.join(root_dir, 'a.md'),
+                      os.path.join(root_dir, 'd', 'a.md'))
+            search_index.update(os.path.join(root_dir, 'a.md'))
+            search_index.update(os.path.join(root_dir, 'd'))
+            self.assertEqual(['/d/a.md'], [
+                result['file'] for result in search_index.search('lion')])
+            self.assertNotEqual(generation, search_index.generation())
+
+            search_index.sync(['/b.md'])
+            self.assertEqual([], search_index.search('lion'))
+            # Opened again, eg. after a restart.
+            self.assertTrue(serve._SearchIndex(
+                root_dir, search_index.db_path).ready.is_set())
+
+    def test_search_index_concurrent_sync(self):
+        with tempfile.TemporaryDirectory() as root_dir:
+            paths = ['/%d.md' % i for i in range(3)]
+            for path in paths:
+                with open(root_dir + path, 'w') as f:
+                    f.write('zebra')
+            db_path = os.path.join(root_dir, 'index.sqlite')
+            index1 = serve._SearchIndex(root_dir, db_path)
+            index2 = serve._SearchIndex(root_dir, db_path)
+            threads = []
+            is_indexable = serve._is_indexable
+
+            def sync_meanwhile(path):
+                # Another worker syncs while the first one is indexing.
+                if not threads:
+                    threads.append(threading.Thread(
+                        target=index2.sync, args=(paths,)))
+                    threads[0].start()
+                    time.sleep(0.2)
+                return is_indexable(path)
+
+            with mock.patch.object(serve, '_is_indexable', sync_meanwhile):
+                index1.sync(paths)
+            threads[0].join()
+            self.assertTrue(index1.ready.is_set())
+            self.assertTrue(index2.ready.is_set())
+            self.assertEqual(
+                paths, sorted(r['file'] for r in index2.search('zebra')))
+
+    @unittest.skipUnless(serve.fcntl, 'needs flock')
+    def test_claim_periodic_task(self):
+        with tempfile.TemporaryDirectory() as config_dir:
+            path = os.path.join(config_dir, 'index.sqlite.sync')
+            self.assertTrue(serve._claim_periodic_task(path, 60))
+            # The other workers skip it until the interval is over.
+            self.assertFalse(serve._claim_periodic_task(path, 60))
+            self.assertTrue(serve._claim_periodic_task(path, 0))
+            with open(path, 'ab') as f:
+                serve.fcntl.flock(f, serve.fcntl.LOCK_EX)
+                self.assertFalse(serve._claim_periodic_task(path, 0))
+
+    def test_to_fts_query(self):
+        self.assertEqual('"a" "b""c"', serve._to_fts_query('a b"c'))
+        self.assertEqual('"a" "bc"*', serve._to_fts_query(' a bc ', True))
+        self.assertEqual('', serve._to_fts_query(' ', True))
+
+    def test_search_generations(self):
+        generations = serve._SearchGenerations(2)
+        first = generations.start('c1', 1)
+        self.assertFalse(first.is_set())
+        second = generations.start('c1', 2)
+        self.assertTrue(first.is_set())
+        self.assertFalse(second.is_set())
+        self.assertIsNone(generations.start('c1', 1))
+        self.assertFalse(generations.start('c2', 1).is_set())
+        generations.start('c3', 1)
+        # c1 is evicted.
+        self.assertIsNotNone(generations.start('c1', 1))
+
+    def test_rank_search_results(self):
+        with tempfile.TemporaryDirectory() as root_dir:
+            for name, mtime in (('a.md', 1), ('b.md', 2), ('apple.md', 0)):
+                path = os.path.join(root_dir, name)
+                open(path, 'w').close()
+                os.utime(path, (mtime, mtime))
+            results = [
+                {'file': '/a.md', 'matches': [{}, {}]},
+                {'file': '/b.md', 'matches': [{}]},
+                {'file': '/gone.md', 'matches': [{}, {}]},
+                {'file': '/apple.md', 'matches': [{}]},
+            ]
+            self.assertEqual(
+                ['/apple.md', '/a.md', '/gone.md', '/b.md'],
+                [result['file'] for result in serve._rank_search_results(
+                    results, 'Apple pie', None, root_dir)])
+            self.assertEqual(
+                ['/b.md', '/a.md', '/gone.md', '/apple.md'],
+                [result['file'] for result in serve._rank_search_results(
+                    results, 'b', re.compile('b'), root_dir)])
+
+    def test_regex_to_trigram_query(self):
+        self.assertEqual('"error"', serve._regex_to_trigram_query('error'))
+        self.assertEqual('"err" AND "_code"',
+                         serve._regex_to_trigram_query(r'err\d+_code'))
+        self.assertEqual('"foo" AND ("bar" OR "qux")',
+                         serve._regex_to_trigram_query('foo(bar|qux)x*y'))
+        # Optional parts and short literals require nothing.
+        self.assertIsNone(serve._regex_to_trigram_query('(foo)?ab.*'))
+        self.assertIsNone(serve._regex_to_trigram_query('foo|ab'))
+        self.assertEqual('"say ""hi"""',
+                         serve._regex_to_trigram_query('say "hi"'))
+
+    def test_search_index_regex(self):
+        with tempfile.TemporaryDirectory() as root_dir:
+            with open(os.path.join(root_dir, 'a.md'), 'w') as f:
+                f.write('x\nfailed with E1234\nE5678 E9999\n')
+            with open(os.path.join(root_dir, 'b.md'), 'w') as f:
+                f.write('E12 <E99>')
+            search_index = serve._SearchIndex(
+                root_dir, os.path.join(root_dir, 'index.sqlite'))
+            search_index.sync(['/a.md', '/b.md'])
+
+            results, complete = search_index.search_regex(
+                re.compile(r'E\d{4}'))
+            self.assertTrue(complete)
+            self.assertEqual(['/a.md'], [result['file'] for result in results])
+            # One match per line.
+            self.assertEqual(
+                [(2, 'failed with <mark>E1234</mark>'),
+                 (3, '<mark>E5678</mark> E9999')],
+                [(match['line'], match['snippet_html'])
+                 for match in results[0]['matches']])
+
+            results, _ = search_index.search_regex(re.compile('<E9+>'))
+            self.assertEqual('E12 <mark>&lt;E99&gt;</mark>',
+                             results[0]['matches'][0]['snippet_html'])
+            _, complete = search_index.search_regex(
+                re.compile('E'), seconds=-1)
+            self.assertFalse(complete)
+
+    def test_has_nested_repeat(self):
+        def has_nested_repeat(pattern):
+            return serve._has_nested_repeat(serve.sre_parse.parse(pattern))
+        self.assertTrue(has_nested_repeat('(a+)+$'))
+        self.assertTrue(has_nested_repeat('x(?:a|b*)*y'))
+        self.assertTrue(has_nested_repeat('((ab)+c){2,}'))
+        self.assertFalse(has_nested_repeat(r'E\d+ (foo|bar)*'))
+        # Fixed and optional repeats do not backtrack.
+        self.assertFalse(has_nested_repeat(r'(\d{4}-)+'))
+        self.assertFalse(has_nested_repeat('(a?b)+'))
+        self.assertFalse(has_nested_repeat('[(a+)+]'))
+
+    def test_grep_backend_parsers(self):
+        self.assertEqual(
+            [('/n/a.md', 1, 1, 'foo'), ('/n/a.md', 2, 5, 'a foo:b'),
+             ('/n/b.md', 3, 2, 'xfoo')],
+            list(serve._AgBackend().parse([
+                ':/n/a.md', '1;0 3:foo', '2;4 3,8 3:a foo:b', '',
+                ':/n/b.md', '3;1 3:xfoo', ''])))
+        self.assertEqual(
+            [('/n/a.md', 1, 1, 'foo'), ('/n/b.md', 3, 2, 'x:foo')],
+            list(serve._AckBackend().parse([
+                '/n/a.md', '1:1:foo', '', '/n/b.md', '3:2:x:foo', ''])))
+        rg_lines = [
+            '{"type":"begin","data":{"path":{"text":"/n/a.md"}}}',
+            '{"type":"match","data":{"path":{"text":"/n/a.md"},'
+            '"lines":{"text":"h\\u00e9 foo\\n"},"line_number":3,'
+            '"submatches":[{"match":{"text":"foo"},"start":4,"end":7}]}}',
+            '{"type":"summary","data":{}}',
+        ]
+        # Columns are in characters, rg gives bytes.
+        self.assertEqual(
+            [('/n/a.md', 3, 4, 'hé foo')],
+            list(serve._RipgrepBackend().parse(rg_lines)))
+
+    def test_python_grep_backend(self):
+        with tempfile.TemporaryDirectory() as root_dir:
+            with open(os.path.join(root_dir, 'a.md'), 'w') as f:
+                f.write('x\nsome foo here\n')
+            with open(os.path.join(root_dir, 'b.bin'), 'wb') as f:
+                f.write(b'foo\0')
+            with serve.app.app_context():
+                scan = serve._PythonGrepBackend().scan('fo+', root_dir, False)
+                self.assertEqual(
+                    [(os.path.join(root_dir, 'a.md'), 2, 6, 'some foo here')],
+                    list(scan))
+                self.assertEqual([], list(serve._PythonGrepBackend().scan(
+                    'fo+', root_dir, True)))
+            with open(os.path.join(root_dir, 'a.md'), 'w') as f:
+                f.write('héllo café\n')
+            with serve.app.app_context():
+                for pattern in ('h.llo', r'caf\w', r'caf[^x]\b'):
+                    self.assertEqual(1, len(list(
+                        serve._PythonGrepBackend().scan(
+                            pattern, root_dir, False))), pattern)
+
+    def test_grep_search_cache_across_workers(self):
+        def search(root_dir):
+            results = serve._iter_ranked_search('foo', None, False, root_dir)
+            while True:
+                try:
+                    next(results)
+                except StopIteration as stop:
+                    ranked, stats, _ = stop.value
+                    return [result['file'] for result in ranked], stats
+
+        with tempfile.TemporaryDirectory() as root_dir:
+            with open(os.path.join(root_dir, 'a.md'), 'w') as f:
+                f.write('foo\n')
+            open(os.path.join(root_dir, 'b.md'), 'w').close()
+            path = os.path.join(root_dir, 'content_generation')
+            other_worker_generation = serve._SharedGeneration(path)
+            with mock.patch.object(serve, '_content_generation',
+                                      serve._SharedGeneration(path)), \
+                    mock.patch.object(serve.args, 'search_backend', 'python'), \
+                    mock.patch.object(serve, '_grep_backend',
+                                      serve._PythonGrepBackend()), \
+                    serve.app.app_context():
+                self.assertEqual(['/a.md'], search(root_dir)[0])
+                self.assertTrue(search(root_dir)[1].endswith(', cached'))
+
+                # Written through another worker.
+                with open(os.path.join(root_dir, 'b.md'), 'w') as f:
+                    f.write('foo foo\n')
+                other_worker_generation.bump()
+                files, stats = search(root_dir)
+                self.assertEqual(['/a.md', '/b.md'], sorted(files))
+                self.assertFalse(stats.endswith(', cached'))
+
+    def _client(self, root_dir, grep_backend=None):
+        """Test client serving root_dir without a login.
+
+        With grep_backend set, searches run it instead of the index.
+        """
+        stack = contextlib.ExitStack()
+        self.addCleanup(stack.close)
+        stack.enter_context(mock.patch.dict(
+            serve.app.config, {'LOGIN_DISABLED': True}))
+        stack.enter_context(mock.patch.object(serve, '_WORKING_DIR', root_dir))
+        stack.enter_context(mock.patch.object(
+            serve.args, 'allow_multi_user', False))
+        if grep_backend is not None:
+            stack.enter_context(mock.patch.object(
+                serve.args, 'search_backend', grep_backend.name))
+            stack.enter_context(mock.patch.object(
+                serve, '_grep_backend', grep_backend))
+        return serve.app.test_client()
+
+    def test_search_stream(self):
+        with tempfile.TemporaryDirectory() as root_dir:
+            for name in ('a', 'b', 'c'):
+                with open(os.path.join(root_dir, name + '.md'), 'w') as f:
+                    f.write('x\nfoo %s\n' % name)
+            client = self._client(root_dir, serve._PythonGrepBackend())
+
+            response = client.get('/api/search_stream?query=foo')
+            self.assertEqual('application/x-ndjson', response.mimetype)
+            lines = [json.loads(line)
+                     for line in response.get_data(True).splitlines()]
+            # A line per file, then the stats.
+            self.assertEqual(
+                ['/a.md', '/b.md', '/c.md'],
+                sorted(line['file'] for line in lines[:-1]))
+            self.assertEqual(2, lines[0]['matches'][0]['line'])
+            last_line = lines[-1]
+            self.assertEqual('success', last_line['result'])
+            self.assertEqual(3, last_line['total'])
+            self.assertIn('3 files matched', last_line['stats'])
+            self.assertFalse(last_line['ranked'])
+            self.assertEqual(3, len(last_line['results']))
+
+            # Served ranked from the cache the second time.
+            lines = client.get(
+                '/api/search_stream?query=foo&limit=2').get_data(
+                    True).splitlines()
+            self.assertEqual(3, len(lines))
+            last_line = json.loads(lines[-1])
+            self.assertTrue(last_line['ranked'])
+            self.assertEqual(3, last_line['total'])
+
+    def test_search_stream_limit(self):
+        with tempfile.TemporaryDirectory() as root_dir:
+            for i in range(serve._SEARCH_RANKED_LIMIT + 1):
+                with open(os.path.join(root_dir, '%d.md' % i), 'w') as f:
+                    f.write('foo')
+            client = self._client(root_dir, serve._PythonGrepBackend())
+
+            lines = client.get(
+                '/api/search_stream?query=foo&limit=2').get_data(
+                    True).splitlines()
+            self.assertEqual(3, len(lines))
+            self.assertEqual(2, len(json.loads(lines[-1])['results']))
+            # Clamped to the ranked results.
+            lines = client.get(
+                '/api/search_stream?query=foo&limit=5000').get_data(
+                    True).splitlines()
+            self.assertEqual(1000, serve._SEARCH_RANKED_LIMIT)
+            self.assertEqual(1001, len(lines))
+            self.assertEqual(1000, json.loads(lines[-1])['total'])
+            self.assertEqual('offset and limit should be numbers', client.get(
+                '/api/search_stream?query=foo&limit=x').json['result'])
+
+    def test_search_stream_close(self):
+        class SlowBackend(serve._AgBackend):
+            # Finds two files, then hangs.
+            def command(self, query, root_dir, literal):
+                return [sys.executable, '-c', (
+                    'import time\n'
+                    'for name in ("a", "b"):\n'
+                    '    print(":%%s/%%s.md" %% (%r, name))\n'
+                    '    print("1;0 3:foo")\n'
+                    'print("", flush=True)\n'
+                    'time.sleep(60)\n') % root_dir]
+
+        with tempfile.TemporaryDirectory() as root_dir:
+            client = self._client(root_dir, SlowBackend())
+            processes = []
+            popen = subprocess.Popen
+
+            def record_popen(*args, **kwargs):
+                processes.append(popen(*args, **kwargs))
+                return processes[-1]
+
+            with mock.patch.object(serve.subprocess, 'Popen', record_popen):
+                response = client.get(
+                    '/api/search_stream?query=foo', buffered=False)
+                first_line = json.loads(next(iter(response.response)))
+                self.assertEqual('/a.md', first_line['file'])
+                self.assertIsNone(processes[0].poll())
+                # The client goes away.
+                start = time.time()
+                response.close()
+            self.assertIsNotNone(processes[0].poll())
+            self.assertLess(time.time() - start, 10)
+
+    def test_is_bytes_safe(self):
+        self.assertTrue(serve._is_bytes_safe('foo+'))
+        self.assertTrue(serve._is_bytes_safe(re.escape('a.b[c]')))
+        self.assertTrue(serve._is_bytes_safe(r'\n|x$'))
+        self.assertFalse(serve._is_bytes_safe('h.llo'))
+        self.assertFalse(serve._is_bytes_safe('[^x]'))
+        self.assertFalse(serve._is_bytes_safe(r'caf\w'))
+        self.assertFalse(serve._is_bytes_safe(r'\bx'))
+        self.assertFalse(serve._is_bytes_safe(r'\u00e9'))
+        self.assertFalse(serve._is_bytes_safe('(?i)x'))
+        self.assertFalse(serve._is_bytes_safe('é'))
+
+    def test_grep_file(self):
+        with tempfile.TemporaryDirectory() as root_dir:
+            path = os.path.join(root_dir, 'a.md')
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write('é foo foo\nbar\nfoo\n')
+            self.assertEqual(
+                [(1, 3, 'é foo foo'), (3, 1, 'foo')],
+                serve._grep_file(re.compile(b'foo'), path))
+            self.assertEqual(
+                [(1, 1, 'é foo foo')],
+                serve._grep_file(re.compile('é'), path))
+            self.assertEqual(
+                [(path, 3, 1, 'foo')],
+                serve._grep_files('^foo', re.MULTILINE, [path],
+                                  time.time() + 60))
+            # Shards stop at the deadline of the search.
+            self.assertEqual([], serve._grep_files(
+                '^foo', re.MULTILINE, [path], time.time() - 1))
+            with open(path, 'wb') as f:
+                f.write(b'foo\0')
+            self.assertEqual([], serve._grep_file(re.compile(b'foo'), path))
+            open(path, 'w').close()
+            self.assertEqual([], serve._grep_file(re.compile(b'foo'), path))
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -18,7 +18,7 @@ setuptools.setup(
     packages=setuptools.find_packages(),
     install_requires=[
         "flask>=1.1.1",
-        "Flask-Caching>=1.8.0",
+        "Flask-Caching>=1.10.0",
         "Flask-HTTPAuth>=3.3.0",
         "email_validator>=1.1.1",
         "atomicfile>=1.0.1",